@@ -1,23 +1,15 @@
 import os
-from urllib.parse import urljoin
-import requests
-from bs4 import BeautifulSoup
+try:
+    from ..documentsdownloader import DownloadStats, download_page_docs
+except ImportError:
+    from documentsdownloader import DownloadStats, download_page_docs
 
 
 class DocDownloader:
     def __init__(self, url):
         self.url = url
 
-    def download_docs(self):
+    def download_docs(self) -> DownloadStats:
         # If there is no such folder, the script will create one automatically
         folder_location = os.getcwd() + r'webscraping'
-        if not os.path.exists(folder_location):
-            os.mkdir(folder_location)
-
-        response = requests.get(self.url)
-        soup = BeautifulSoup(response.text, "html.parser")
-        for link in soup.select("a[href*='.doc']"):
-            # Name the doc files using the last portion of each link which are unique in this case
-            filename = os.path.join(folder_location, link['href'].split('/')[-1])
-            with open(filename, 'wb') as f:
-                f.write(requests.get(urljoin(self.url, link['href'])).content)
+        return download_page_docs(self.url, ['doc'], folder_location)
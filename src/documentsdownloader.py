@@ -2,21 +2,58 @@
 ## SECTION: Imports                                             #
 ##==============================================================#
 
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
 from dataclasses import asdict, dataclass, field
+from html.parser import HTMLParser
 from pathlib import Path
-from typing import Any, Dict, List, Set
-from urllib.parse import ParseResult, urljoin, urlparse, urlunsplit
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from urllib.parse import ParseResult, urljoin, urlparse, urlunparse, urlunsplit
+from urllib.robotparser import RobotFileParser
+import base64
+import email.utils
+import errno
+import gzip
+import hashlib
+import io
 import json
 import logging
+import multiprocessing
+import os
 import posixpath
 import os.path as op
+import queue
+import shutil
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, UnicodeDammit
 from pathvalidate import sanitize_filename
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
 import click
 import requests
 
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
 ##==============================================================#
 ## SECTION: Global Definitions                                  #
 ##==============================================================#
@@ -30,14 +67,86 @@ OPTIONS = {
         click.option('--ext', multiple=True, help='Extensions to locate/download.')
     ],
     'locate': [
+        click.option('--locate-parser', default='html.parser', show_default=True, type=click.Choice(['html.parser', 'lxml'], case_sensitive=True), help='Backend used to extract links from crawled pages, lxml is faster when installed.'),
+        click.option('--locate-near-duplicate-distance', default=0, show_default=True, type=click.IntRange(min=0, max=3), help='Skip pages whose link set simhash is within given Hamming distance of a visited page, 0 to only skip exact duplicates.'),
+        click.option('--locate-visit-limit', default=250, show_default=True, type=click.IntRange(min=0), help='Maximum number of pages to visit while crawling, 0 for no limit.'),
+        click.option('--locate-compact-visited', is_flag=True, help='Keep visited and discovered URLs as 64-bit hashes, uses a fraction of the memory on large crawls.'),
+        click.option('--locate-sitemaps', is_flag=True, help='Read the sitemaps listed in robots.txt or at /sitemap.xml first, locating docs they list directly and queueing their pages under the target path.'),
+        click.option('--locate-max-page-size', default=10, show_default=True, type=click.IntRange(min=1), help='Drop crawled pages larger than given number of MB.'),
+        click.option('--locate-parse-workers', default=0, show_default=True, type=click.IntRange(min=0), help='Parse crawled pages in given number of worker processes so parsing uses several cores, 0 to parse them in the crawling process.'),
+        click.option('--locate-workers', default=4, show_default=True, type=click.IntRange(min=1), help='Number of pages to fetch concurrently while crawling, 1 for a deterministic crawl.'),
         click.option('--locate-outfile', default='__output__/locations-{exts}-{target}.json', show_default=True, help='Save location info to given file path, overwrites existing. Use {exts} and {target} to autofill those values.'),
+        click.option('--locate-format', default='json', show_default=True, type=click.Choice(['json', 'jsonl', 'sqlite'], case_sensitive=True), help='Format of the location file, jsonl appends each location as soon as it is found, sqlite stores them in an indexed database that also caches download status.'),
+        click.option('--locate-checkpoint', default='__output__/checkpoint-{exts}-{target}.json', show_default=True, help='Periodically save crawl state to given file path, removed once the crawl completes. Use {exts} and {target} to autofill those values, empty to disable.'),
+        click.option('--resume', is_flag=True, help='Resume an interrupted crawl from its checkpoint.')
+    ],
+    'target': [
         click.argument('target')
     ],
+    'batch': [
+        click.option('--batch-workers', default=4, show_default=True, type=click.IntRange(min=1), help='Number of targets to locate concurrently.'),
+        click.option('--batch-download', is_flag=True, help='Download the documents located from all targets.'),
+        click.option('--batch-summary', default='__output__/batch-summary.json', show_default=True, help='Write the combined summary of the batch to given JSON file path, empty to disable.'),
+        click.argument('targets_file', type=click.Path(exists=True, dir_okay=False))
+    ],
+    'cache': [
+        click.option('--cache-dir', default='', help='Cache crawled pages in given directory and revalidate them on later runs, empty to disable.'),
+        click.option('--cache-max-size', default=1024, show_default=True, type=click.IntRange(min=1), help='Maximum size of the page cache in MB, least recently used pages are evicted first.'),
+        click.option('--cache-max-age', default=30.0, show_default=True, type=click.FloatRange(min=0), help='Evict cached pages older than given number of days, 0 for no limit.')
+    ],
+    'http': [
+        click.option('--http-pool-connections', default=32, show_default=True, type=click.IntRange(min=1), help='Number of hosts to keep pooled keep-alive connections for.'),
+        click.option('--http-pool-maxsize', default=16, show_default=True, type=click.IntRange(min=1), help='Maximum keep-alive connections pooled per host, should be at least the number of workers.'),
+        click.option('--http-timeout', default=30.0, show_default=True, type=click.FloatRange(min=0, min_open=True), help='Seconds to wait for a server to connect or send data.'),
+        click.option('--http-retries', default=3, show_default=True, type=click.IntRange(min=0), help='Retries for connection errors and 429/5xx responses.'),
+        click.option('--http-backoff', default=0.5, show_default=True, type=click.FloatRange(min=0), help='Exponential backoff factor in seconds between retries, Retry-After headers take precedence.')
+    ],
+    'metrics': [
+        click.option('--metrics-json', default='', help='Write per-phase and per-host counters and latency histograms of the run to given JSON file path.'),
+        click.option('--metrics-prometheus', default='', help='Write the run metrics to given file path in the Prometheus textfile format.')
+    ],
+    'politeness': [
+        click.option('--politeness-robots/--no-politeness-robots', default=True, show_default=True, help='Skip pages and documents disallowed by robots.txt and honor its Crawl-delay.'),
+        click.option('--politeness-max-concurrency', default=8, show_default=True, type=click.IntRange(min=1), help='Upper bound of the concurrent requests per host, which adapts to the latency and errors seen from the host.'),
+        click.option('--politeness-min-delay', default=0.0, show_default=True, type=click.FloatRange(min=0), help='Minimum seconds between the start of requests to the same host.')
+    ],
     'download': [
-        click.option('--download-outdir', default='__output__', show_default=True, help='Directory to download located files, overwrites existing files.')
+        click.option('--download-outdir', default='__output__', show_default=True, help='Directory to download located files, overwrites existing files.'),
+        click.option('--download-manifest', default='{outdir}/manifest.json', show_default=True, help='Record document validators to given file path and skip unchanged documents on later runs, empty to disable. Use {outdir} to autofill the download directory.'),
+        click.option('--download-store', default='', help='Save each unique document once under its SHA-256 in given directory and link the per-URL download paths to it, empty to disable. Use {outdir} to autofill the download directory.'),
+        click.option('--download-store-link', default='hardlink', show_default=True, type=click.Choice(['hardlink', 'symlink'], case_sensitive=True), help='How download paths link to the stored documents, falls back to symlinks then copies where links are unsupported.'),
+        click.option('--download-workers', default=4, show_default=True, type=click.IntRange(min=1), help='Number of documents to download concurrently.'),
+        click.option('--download-host-limit', default=2, show_default=True, type=click.IntRange(min=0), help='Maximum concurrent downloads per host, 0 for no limit.'),
+        click.option('--download-range-parts', default=4, show_default=True, type=click.IntRange(min=1), help='Byte ranges of a large document to fetch in parallel when the server accepts ranges, 1 to fetch documents in one stream. The parallel ranges count against --download-host-limit.'),
+        click.option('--download-range-threshold', default=32, show_default=True, type=click.IntRange(min=1), help='Minimum size in MB of documents fetched in byte ranges, interrupted ranged downloads resume from their .part file.')
     ]
 }
 
+CHUNK_SIZE = 64 * 1024
+
+LOCATION_DB_EXTS = ['.sqlite', '.db']
+
+MAX_PAGE_SIZE = 10 * 1024 * 1024
+HTML_CONTENT_TYPES = ['text/html', 'application/xhtml+xml']
+GENERIC_CONTENT_TYPES = ['', 'text/plain', 'application/octet-stream', 'binary/octet-stream']
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+PAGE_CACHE = None
+
+SESSION = None
+SESSION_LOCK = threading.RLock()
+
+METRICS = None
+NULL_TIMER = nullcontext()
+
+SCHEDULER = None
+
+PAGE_DOCS: 'OrderedDict[str, Tuple[float, Tuple[Location, ...]]]' = OrderedDict()
+PAGE_DOCS_LOCK = threading.Lock()
+PAGE_DOCS_LIMIT = 32
+PAGE_DOCS_TTL = 60.0
+
 DOCTYPE_MAP = {
     'doc': ['doc', 'docx'],
     'excel': ['csv', 'xls', 'xlsx', 'xlt', 'xla', 'xml'],
@@ -66,23 +175,108 @@ class Location:
             relpath += self.docext
         return Path(op.normpath(op.join(basedir, relpath)))
 
+@dataclass
+class ParsedPage:
+    """What a crawl keeps of a page: its fingerprint, doc links, canonical child links under the crawl scope and link set simhash."""
+    pagehash: str
+    docurls: List[str]
+    childurls: List[str]
+    signature: Optional[int] = None
+
 class BaseLocator(object):
-    def __init__(self, target, exts):
+    CHECKPOINT_INTERVAL = 30
+    def __init__(self, target, exts, checkpoint=None, on_location: Optional[Callable[[Location], None]]=None, stop: Optional[threading.Event]=None):
         self.target = target
         self.exts = exts
+        self.checkpoint = checkpoint
+        self.checkpointed = time.monotonic()
+        self.on_location = on_location
+        self.stop = stop
         self.visited: Set[str] = set()
         self.locations: List[Location] = []
 
+    def add_location(self, location: Location) -> None:
+        self.locations.append(location)
+        if self.on_location:
+            self.on_location(location)
+
+    def iter_locations(self) -> Iterator[Location]:
+        return iter(self.locations)
+
+    def check_stop(self) -> None:
+        """Interrupts a crawl running in a worker thread, which never receives KeyboardInterrupt itself."""
+        if self.stop and self.stop.is_set():
+            raise KeyboardInterrupt()
+
+    def get_state(self) -> Dict[str, Any]:
+        return {}
+
+    def set_state(self, state: Dict[str, Any]) -> None:
+        pass
+
+    def load_checkpoint(self) -> bool:
+        if not self.checkpoint or not op.isfile(self.checkpoint):
+            logging.info('No checkpoint to resume from, starting a new crawl')
+            return False
+        with open(self.checkpoint) as fi:
+            state = json.load(fi)
+        if state.get('target') != self.target or state.get('exts') != list(self.exts):
+            logging.warning(f'Ignoring checkpoint for a different target or extensions: {self.checkpoint}')
+            return False
+        self.visited = set(state['visited'])
+        for locdata in state['locations']:
+            self.add_location(Location(**locdata))
+        self.set_state(state)
+        logging.info(f'Resuming crawl from {self.checkpoint}, visited {len(self.visited)} pages, located {len(self.locations)} docs')
+        return True
+
+    def save_checkpoint(self, force=False) -> None:
+        if not self.checkpoint:
+            return
+        if not force and time.monotonic() - self.checkpointed < BaseLocator.CHECKPOINT_INTERVAL:
+            return
+        state = {
+            'target': self.target,
+            'exts': list(self.exts),
+            'visited': list(self.visited),
+            'locations': [asdict(location) for location in self.locations],
+        }
+        state.update(self.get_state())
+        outpath = Path(self.checkpoint)
+        outpath.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(outpath, [json.dumps(state).encode()])
+        self.checkpointed = time.monotonic()
+        logging.debug(f'Saved checkpoint to {self.checkpoint}')
+
+    def clear_checkpoint(self) -> None:
+        if self.checkpoint and op.isfile(self.checkpoint):
+            os.unlink(self.checkpoint)
+
 class JsonLocator(BaseLocator):
-    def __init__(self, target, exts):
+    def __init__(self, target, exts, lazy=False):
         super().__init__(target, exts)
         self.target = op.realpath(target)
-        with open(self.target) as fi:
-            for locdata in json.load(fi):
-                location = Location(**locdata)
-                if location.docext in exts:
-                    self.locations.append(location)
-        logging.info(f'Read {len(self.locations)} doc locations from file')
+        self._locations = None
+        if not lazy:
+            logging.info(f'Read {len(self.locations)} doc locations from file')
+
+    @property
+    def locations(self) -> List[Location]:
+        if self._locations is None:
+            self._locations = list(self.iter_locations())
+        return self._locations
+
+    @locations.setter
+    def locations(self, locations: List[Location]) -> None:
+        self._locations = locations
+
+    def iter_locations(self) -> Iterator[Location]:
+        if self._locations is not None:
+            yield from self._locations
+            return
+        for location in read_locations(self.target):
+            if self.exts is None or location.docext in self.exts:
+                yield location
 
 class TxtLocator(BaseLocator):
     def __init__(self, target, exts):
@@ -95,131 +289,1534 @@ class TxtLocator(BaseLocator):
                     self.locations.append(Location(self.target, self.target, docurl, docext))
         logging.info(f'Read {len(self.locations)} doc locations from file')
 
-class DocumentCenterLocator(BaseLocator):
+class SqliteLocator(BaseLocator):
+    """Reads locations from a location database, deduplicated by docurl."""
+
     def __init__(self, target, exts):
         super().__init__(target, exts)
+        self.target = op.realpath(target)
+        self._locations = None
+        with LocationStore(self.target, readonly=True) as store:
+            logging.info(f'Read {store.count(exts)} doc locations from database')
+
+    @property
+    def locations(self) -> List[Location]:
+        if self._locations is None:
+            self._locations = list(self.iter_locations())
+        return self._locations
+
+    @locations.setter
+    def locations(self, locations: List[Location]) -> None:
+        self._locations = locations
+
+    def iter_locations(self) -> Iterator[Location]:
+        if self._locations is not None:
+            yield from self._locations
+            return
+        with LocationStore(self.target, readonly=True) as store:
+            yield from store.iter_locations(self.exts, unique=True)
+
+class DocumentCenterLocator(BaseLocator):
+    def __init__(self, target, exts, workers=1, checkpoint=None, resume=False, on_location=None, stop=None):
+        super().__init__(target, exts, checkpoint, on_location, stop)
         self.base = urlparse(target)
-        logging.info(f'Starting locator at {self.target}')
+        self.workers = max(1, workers)
+        self.frontier: Deque[Tuple[str, str]] = deque()
+        self.running: Dict[str, Tuple[str, Future, Future]] = OrderedDict()
+        self.seen: Set[str] = set()
+        logging.info(f'Starting locator at {self.target} with {self.workers} workers')
         logging.info(f'Locating file extensions: {self.exts}')
-        soup = get_soup(self.target)
-        if soup:
-            tags = soup.select('div.t-mid')
-            for tag in tags:
-                path = tag.select('span.t-in')[0].text
-                value = tag.select('input.t-input')[0].get('value')
-                self.visit(path, value)
+        if not (resume and self.load_checkpoint()):
+            soup = get_soup(self.target)
+            if soup:
+                tags = soup.select('div.t-mid')
+                for tag in tags:
+                    path = tag.select('span.t-in')[0].text
+                    value = tag.select('input.t-input')[0].get('value')
+                    self.enqueue(path, value)
+        self.run()
+        self.clear_checkpoint()
         logging.info(f'Completed locating, visited {len(self.visited)} pages, located {len(self.locations)} docs')
 
-    def visit(self, path, value) -> None:
+    def get_state(self) -> Dict[str, Any]:
+        inflight = [(path, value) for value, (path, _, _) in self.running.items()]
+        return {'frontier': inflight + list(self.frontier)}
+
+    def set_state(self, state: Dict[str, Any]) -> None:
+        self.frontier = deque(tuple(folder) for folder in state['frontier'])
+        self.seen = self.visited.union(value for _, value in self.frontier)
+
+    def enqueue(self, path, value) -> None:
+        if value not in self.seen:
+            self.seen.add(value)
+            self.frontier.append((path, value))
+
+    def run(self) -> None:
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                self.dispatch(executor)
+            except KeyboardInterrupt:
+                self.save_checkpoint(force=True)
+                raise
+
+    def dispatch(self, executor: ThreadPoolExecutor) -> None:
+        while self.frontier or self.running:
+            self.check_stop()
+            while self.frontier and len(self.running) < self.workers:
+                path, value = self.frontier.popleft()
+                if value in self.visited:
+                    continue
+                logging.info(f'Visiting folder {path} Value={value}')
+                docs = executor.submit(self.fetch_docs, value)
+                subdirs = executor.submit(self.fetch_subdirs, path, value)
+                self.running[value] = (path, docs, subdirs)
+            if not self.running:
+                continue
+            wait([future for _, docs, subdirs in self.running.values() for future in (docs, subdirs)], return_when=FIRST_COMPLETED)
+            # Commit folders in submission order once both of their listings have arrived.
+            for value, (path, docs, subdirs) in list(self.running.items()):
+                if docs.done() and subdirs.done():
+                    try:
+                        self.visit(path, value, docs.result(), subdirs.result())
+                    except Exception:
+                        logging.error(f'Could not visit folder {path} Value={value}')
+                    del self.running[value]
+            self.save_checkpoint()
+
+    def fetch_docs(self, value) -> List[Dict[str, Any]]:
+        url = to_absolute_url(self.base, urlparse('Home/Document_AjaxBinding'))
+        docs = DocumentCenterLocator.send_post(url, {'id': value}, {'data': []})
+        return docs.get('data') or []
+
+    def fetch_subdirs(self, path, value) -> List[Tuple[str, str]]:
+        url = to_absolute_url(self.base, urlparse('Home/_AjaxLoading'))
+        subdirs = DocumentCenterLocator.send_post(url, {'Value': value}, [])
+        return [(op.join(path, subdir['Text']), subdir['Value']) for subdir in subdirs]
+
+    def visit(self, path, value, docs: List[Dict[str, Any]], subdirs: List[Tuple[str, str]]) -> None:
         url = to_absolute_url(self.base, urlparse('Home/Document_AjaxBinding'))
         self.visited.add(value)
-        logging.info(f'Visiting {url} Value={value}')
-        docs = DocumentCenterLocator.send_post(url, {'id': value})
-        for doc in docs['data']:
+        for doc in docs:
             docext = '.' + doc['FileType']
             if docext in self.exts:
                 docurl = to_absolute_url(self.base, urlparse(doc['URL']))
                 extra = {'dir': path, 'name': doc['DisplayName']}
-                self.locations.append(Location(self.target, url, docurl, docext, extra))
+                self.add_location(Location(self.target, url, docurl, docext, extra))
         logging.info(f'Current total found doc locations: {len(self.locations)}')
-        self.crawl(path, value)
-
-    def crawl(self, path, value) -> None:
-        url = to_absolute_url(self.base, urlparse('Home/_AjaxLoading'))
-        subdirs = DocumentCenterLocator.send_post(url, {'Value': value})
-        for subdir in subdirs:
-            subpath = op.join(path, subdir['Text'])
-            subvalue = subdir['Value']
-            is_unvisited = subvalue not in self.visited
-            if is_unvisited:
-                self.visit(subpath, subvalue)
+        for subpath, subvalue in subdirs:
+            self.enqueue(subpath, subvalue)
 
     @staticmethod
-    def send_post(url: str, body) -> Any:
+    def send_post(url: str, body, default: Any) -> Any:
         try:
             headers = {
               'X-Requested-With': 'XMLHttpRequest',
               'getDocuments': '1',
             }
-            response = requests.post(url, headers=headers, data=body)
+            with timed('fetch', url):
+                response = get_session().post(url, headers=headers, data=body)
+            count_response(url, response)
+            response.raise_for_status()
             return response.json()
         except Exception:
             logging.error(f'Could not retrieve content from URL: {url}')
+            return default
 
 class WebLocator(BaseLocator):
     VISITED_LIMIT = 250
-    def __init__(self, target, exts):
-        super().__init__(target, exts)
+    VISITABLE_EXTS = ['.com', '.net', '.org', '.gov', '.html', '.htm', '.php', '.asp', '.aspx']
+    SITEMAP_LIMIT = 1000
+    CONTENT_TYPE_TRUST = 3
+    def __init__(self, target, exts, workers=1, checkpoint=None, resume=False, on_location=None, parser='html.parser', near_duplicate_distance=0,
+                 visit_limit=None, compact_visited=False, sitemaps=False, max_page_size=MAX_PAGE_SIZE, parse_workers=0, stop=None):
+        super().__init__(target, exts, checkpoint, on_location, stop)
         self.base = get_baseurl(target)
         self.path = urlparse(target).path
-        self.skipped_urls = set()
-        self.visited_hashes = set()
-        logging.info(f'Starting locator at {self.target}')
+        self.scope = canonicalize_url(target) + ('/' if target.endswith('/') and self.path.strip('/') else '')
+        self.workers = max(1, workers)
+        self.parser = parser
+        self.visit_limit = WebLocator.VISITED_LIMIT if visit_limit is None else visit_limit
+        self.compact_visited = compact_visited
+        self.max_page_size = max_page_size
+        self.parse_workers = parse_workers
+        self.parse_pool: Optional[ProcessPoolExecutor] = None
+        self.content_types: Dict[Tuple[str, str, str], List[int]] = {}
+        self.frontier: Deque[str] = deque()
+        self.running: Dict[Future, str] = {}
+        self.visited = self.new_url_set()
+        self.seen = self.new_url_set()
+        self.skipped_urls = self.new_url_set()
+        self.visited_hashes: Set[str] = set()
+        self.simhashes = SimhashIndex(near_duplicate_distance) if near_duplicate_distance else None
+        self.duplicates = 0
+        logging.info(f'Starting locator at {self.target} with {self.workers} workers')
         logging.info(f'Locating file extensions: {self.exts}')
-        self.visit(self.target)
-        logging.info(f'Completed locating, visited {len(self.visited)} pages, located {len(self.locations)} docs')
+        if not (resume and self.load_checkpoint()):
+            self.enqueue(canonicalize_url(self.target))
+            if sitemaps:
+                self.read_sitemaps()
+        self.run()
+        self.clear_checkpoint()
+        logging.info(f'Completed locating, visited {len(self.visited)} pages, skipped {self.duplicates} duplicate pages, located {len(self.locations)} docs')
+
+    def new_url_set(self, urls: Iterable=()):
+        return HashedUrlSet(urls) if self.compact_visited else set(urls)
+
+    def enqueue(self, url: str) -> None:
+        if url not in self.seen:
+            self.seen.add(url)
+            self.frontier.append(url)
+
+    def get_state(self) -> Dict[str, Any]:
+        inflight = list(self.running.values())
+        visited = self.visited.copy()
+        for url in inflight:
+            visited.discard(url)
+        return {
+            'visited': list(visited),
+            'frontier': inflight + list(self.frontier),
+            'skipped_urls': list(self.skipped_urls),
+            'compact_visited': self.compact_visited,
+            'visited_hashes': list(self.visited_hashes),
+            'simhashes': self.simhashes.simhashes if self.simhashes else [],
+            'duplicates': self.duplicates,
+        }
+
+    def set_state(self, state: Dict[str, Any]) -> None:
+        if state.get('compact_visited') and not self.compact_visited:
+            # Hashed URLs cannot be turned back into strings, keep crawling in compact mode.
+            logging.info('Checkpoint holds hashed URLs, continuing with a compact visited set')
+            self.compact_visited = True
+        self.visited = self.new_url_set(self.visited)
+        self.frontier = deque(state['frontier'])
+        self.skipped_urls = self.new_url_set(state['skipped_urls'])
+        self.visited_hashes = set(state.get('visited_hashes', []))
+        self.duplicates = state.get('duplicates', 0)
+        if self.simhashes:
+            for signature in state.get('simhashes', []):
+                self.simhashes.add(signature)
+        self.seen = self.new_url_set(self.visited)
+        for url in [*self.skipped_urls, *self.frontier]:
+            self.seen.add(url)
+
+    def run(self) -> None:
+        # Workers are started from fetch threads, forking a multi-threaded process could deadlock them on inherited locks.
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        parse_pool = ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=multiprocessing.get_context(start_method)) if self.parse_workers else None
+        with parse_pool or nullcontext(), ThreadPoolExecutor(max_workers=self.workers) as executor:
+            self.parse_pool = parse_pool
+            try:
+                self.dispatch(executor)
+            except KeyboardInterrupt:
+                self.save_checkpoint(force=True)
+                raise
+            finally:
+                self.parse_pool = None
+
+    def dispatch(self, executor: ThreadPoolExecutor) -> None:
+        running = self.running
+        while self.frontier or running:
+            self.check_stop()
+            while self.frontier and len(running) < self.workers:
+                url = self.frontier.popleft()
+                if url in self.visited:
+                    continue
+                visitable = self.check_visitable(url)
+                if visitable is False:
+                    self.skip(url)
+                    continue
+                self.visited.add(url)
+                logging.info(f'Visiting page {len(self.visited)} (limit={self.visit_limit or "none"}) URL: {url}')
+                running[executor.submit(self.fetch, url, visitable is None)] = url
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            # Process in submission order so a single worker crawls deterministically.
+            for future in [future for future in running if future in done]:
+                self.process(running[future], future)
+                del running[future]
+            self.save_checkpoint()
+
+    def process(self, url: str, future: Future) -> None:
+        try:
+            is_html, content = future.result()
+        except Exception:
+            logging.error(f'Could not visit URL: {url}')
+            return
+        if is_html is None:
+            # Failed pages stay visited and tell nothing about the content type of similar URLs.
+            return
+        pattern = WebLocator.get_url_pattern(url)
+        if pattern and (content is not None or not is_html):
+            self.content_types.setdefault(pattern, [0, 0])[0 if is_html else 1] += 1
+        if not is_html:
+            self.visited.discard(url)
+            self.skip(url)
+            return
+        located = len(self.locations)
+        try:
+            self.visit(url, content)
+        except KeyboardInterrupt:
+            # The page stays in flight and is revisited on resume, drop its partial results.
+            del self.locations[located:]
+            raise
+
+    def skip(self, url: str) -> None:
+        self.skipped_urls.add(url)
+        logging.debug(f'Skipping visit to {url}')
 
     def is_visitable(self, url: str) -> bool:
-        if len(self.visited) >= WebLocator.VISITED_LIMIT:
+        visitable = self.check_visitable(url)
+        if visitable is None:
+            return fetch_page(url, sniff=True, max_size=self.max_page_size)[0] is True
+        return visitable
+
+    @staticmethod
+    def get_url_pattern(url: str) -> Optional[Tuple[str, str, str]]:
+        """Host, directory and extension of a URL whose extension does not tell whether it is a page."""
+        parsed = urlparse(url)
+        ext = op.splitext(parsed.path)[1].lower()
+        if not ext or ext in WebLocator.VISITABLE_EXTS:
+            return None
+        return (parsed.netloc, posixpath.dirname(parsed.path), ext)
+
+    def check_visitable(self, url: str) -> Optional[bool]:
+        """Returns whether the URL is visitable, or None if its content type must be sniffed."""
+        if self.visit_limit and len(self.visited) >= self.visit_limit:
             return False
         if url in self.skipped_urls:
             return False
         if is_crawl_loop(url):
             return False
+        if not is_allowed(url):
+            logging.info(f'Skipping URL disallowed by robots.txt: {url}')
+            return False
         ext = op.splitext(url)[1].lower()
         if ext:
-            if ext in ['.com', '.net', '.org', '.gov', '.html', '.htm', '.php', '.asp', '.aspx']:
+            if ext in WebLocator.VISITABLE_EXTS:
                 return True
             if ext in ['.iso', '.exe', '.dmg'] + get_all_doctype_exts():
                 return False
-            try:
-                response = requests.head(url, allow_redirects=True)
-                return 'text/html' in response.headers['Content-Type']
-            except Exception:
-                logging.warning(f'Could not check content type of URL: {url}')
+            # Trust the content type seen for similar URLs once it has been consistent a few times.
+            html, other = self.content_types.get(WebLocator.get_url_pattern(url), [0, 0])
+            if html >= WebLocator.CONTENT_TYPE_TRUST and not other:
+                return True
+            if other >= WebLocator.CONTENT_TYPE_TRUST and not html:
                 return False
+            return None
         return True
 
-    def visit(self, url: str) -> None:
-        if not self.is_visitable(url):
-            self.skipped_urls.add(url)
-            logging.debug(f'Skipping visit to {url}')
-            return
-        self.visited.add(url)
-        logging.info(f'Visiting page {len(self.visited)} (limit={WebLocator.VISITED_LIMIT}) URL: {url}')
+    def fetch(self, url: str, sniff: bool) -> Tuple[Optional[bool], Union[bytes, ParsedPage, None]]:
+        is_html, content = fetch_page(url, sniff, self.max_page_size)
+        if not self.parse_pool or not content:
+            return is_html, content
+        # Only the page bytes go to the worker process and only the parsed page comes back.
+        with timed('parse', url):
+            return is_html, self.parse_pool.submit(parse_page, url, content, self.exts, self.scope, self.parser, bool(self.simhashes)).result()
+
+    def visit(self, url: str, content: Union[bytes, ParsedPage]) -> None:
+        """Locates the docs and queues the child pages of a fetched page, or of a page already parsed by a worker process."""
         try:
-            soup = get_soup(url)
-            souphash = hash(soup)
-            if soup and souphash not in self.visited_hashes:
-                self.visited_hashes.add(souphash)
-                self.find_locations(url, soup)
-                self.crawl(url, soup)
+            if not content:
+                return
+            page = content
+            if not isinstance(page, ParsedPage):
+                pagehash = fingerprint(content)
+                if pagehash in self.visited_hashes:
+                    self.skip_duplicate(url)
+                    return
+                with timed('parse', url):
+                    page = parse_page(url, content, self.exts, self.scope, self.parser, bool(self.simhashes), pagehash)
+            if page.pagehash in self.visited_hashes:
+                self.skip_duplicate(url)
+                return
+            self.visited_hashes.add(page.pagehash)
+            if self.simhashes and not self.simhashes.add(page.signature):
+                self.skip_duplicate(url)
+                return
+            with timed('find_locations', url):
+                self.find_locations(url, page.docurls)
+                self.crawl(url, page.childurls)
         except Exception:
             logging.error(f'Could not visit URL: {url}')
 
-    def crawl(self, url: str, soup: BeautifulSoup) -> None:
-        parsed_url = urlparse(url)
-        for tag in soup.find_all('a', recursive=True):
-            href = tag.get('href')
-            if href:
-                linkurl = to_absolute_url(parsed_url, urlparse(href))
-                is_unvisited = linkurl not in self.visited
-                if is_unvisited and WebLocator.is_subpage(self.target, linkurl):
-                    self.visit(linkurl)
+    def skip_duplicate(self, url: str) -> None:
+        self.duplicates += 1
+        logging.debug(f'Skipping duplicate page {url}')
+
+    def crawl(self, url: str, childurls: List[str]) -> None:
+        for childurl in childurls:
+            self.enqueue(childurl)
 
     @staticmethod
     def is_subpage(base_url: str, subpage_url: str) -> bool:
         return remove_scheme(subpage_url).startswith(remove_scheme(base_url))
 
-    def find_locations(self, url: str, soup: BeautifulSoup) -> None:
-        selector = ', '.join([f'a[href*="{ext}" i]' for ext in self.exts])
-        for tag in set(soup.select(selector)):
-            docurl = to_absolute_url(urlparse(url), urlparse(tag['href']))
+    def find_locations(self, url: str, docurls: List[str]) -> None:
+        for docurl in docurls:
             docext = op.splitext(urlparse(docurl).path)[1].lower()
-            if docext in self.exts:
-                self.locations.append(Location(self.target, url, docurl, docext))
+            self.add_location(Location(self.target, url, docurl, docext))
         logging.info(f'Current total found doc locations: {len(self.locations)}')
 
+    def find_sitemaps(self) -> List[str]:
+        origin = urlunsplit([self.base.scheme, self.base.netloc, '', '', ''])
+        rules = (SCHEDULER and SCHEDULER.get_rules(self.target)) or HostScheduler.fetch_rules(origin)
+        # RobotFileParser.site_maps is missing before Python 3.8.
+        site_maps = getattr(rules, 'site_maps', lambda: None)()
+        return list(site_maps or []) or [f'{origin}/sitemap.xml']
+
+    def read_sitemaps(self) -> None:
+        """Locates the docs and queues the pages listed in the site's sitemaps, both only under the target path."""
+        pending = deque(self.find_sitemaps())
+        read = set(pending)
+        docurls = set()
+        pages = 0
+        sitemaps = 0
+        while pending and sitemaps < WebLocator.SITEMAP_LIMIT:
+            sitemap = pending.popleft()
+            sitemaps += 1
+            logging.info(f'Reading sitemap: {sitemap}')
+            for kind, url in iter_sitemap(sitemap):
+                if kind == 'sitemap':
+                    if url not in read:
+                        read.add(url)
+                        pending.append(url)
+                    continue
+                docext = op.splitext(urlparse(url).path)[1].lower()
+                if docext in self.exts:
+                    # Sitemaps list a whole site, possibly another host's, so docs are limited to the crawl scope like pages.
+                    if url not in docurls and WebLocator.is_subpage(self.scope, canonicalize_url(url)):
+                        docurls.add(url)
+                        self.add_location(Location(self.target, sitemap, url, docext))
+                    continue
+                url = canonicalize_url(url)
+                if WebLocator.is_subpage(self.scope, url) and url not in self.seen:
+                    self.enqueue(url)
+                    pages += 1
+        logging.info(f'Read {sitemaps} sitemaps, located {len(docurls)} docs and queued {pages} pages')
+
+class HashedUrlSet(object):
+    """Set of URLs kept as fixed-width 64-bit hashes instead of strings.
+
+    Takes a fraction of the memory of the URLs themselves, a crawl of ten million URLs has about a one in
+    a million chance of a hash collision, which would skip a single page.
+    """
+    def __init__(self, urls: Iterable=()):
+        self.keys: Set[int] = set()
+        for url in urls:
+            self.add(url)
+
+    @staticmethod
+    def get_key(url) -> int:
+        if isinstance(url, int):
+            return url
+        return int.from_bytes(hashlib.blake2b(url.encode(), digest_size=8).digest(), 'big')
+
+    def add(self, url) -> None:
+        self.keys.add(HashedUrlSet.get_key(url))
+
+    def discard(self, url) -> None:
+        self.keys.discard(HashedUrlSet.get_key(url))
+
+    def copy(self) -> 'HashedUrlSet':
+        return HashedUrlSet(self.keys)
+
+    def __contains__(self, url) -> bool:
+        return HashedUrlSet.get_key(url) in self.keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.keys)
+
+class LinkExtractor(HTMLParser):
+    """Collects the href of every anchor tag in a single pass, without building a tree."""
+
+    def __init__(self):
+        super().__init__()
+        self.hrefs: List[str] = []
+
+    def handle_starttag(self, tag, attrs) -> None:
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.hrefs.append(href)
+
+class SimhashIndex(object):
+    """Finds 64-bit simhashes within a Hamming distance, splitting them into bands so that
+    any two signatures within the distance share at least one identical band."""
+    BANDS = 4
+    def __init__(self, distance):
+        self.distance = distance
+        self.simhashes: List[int] = []
+        self.bands: List[Dict[int, List[int]]] = [{} for _ in range(SimhashIndex.BANDS)]
+
+    @staticmethod
+    def get_bands(signature: int) -> List[int]:
+        width = 64 // SimhashIndex.BANDS
+        return [(signature >> (band * width)) & ((1 << width) - 1) for band in range(SimhashIndex.BANDS)]
+
+    def find(self, signature: int) -> Optional[int]:
+        for band, key in enumerate(SimhashIndex.get_bands(signature)):
+            for candidate in self.bands[band].get(key, []):
+                if bin(candidate ^ signature).count('1') <= self.distance:
+                    return candidate
+        return None
+
+    def add(self, signature: int) -> bool:
+        """Adds the signature unless a near duplicate is already indexed, returns whether it was added."""
+        if self.find(signature) is not None:
+            return False
+        self.simhashes.append(signature)
+        for band, key in enumerate(SimhashIndex.get_bands(signature)):
+            self.bands[band].setdefault(key, []).append(signature)
+        return True
+
+@dataclass
+class DownloadStats:
+    fetched: int = 0
+    skipped: int = 0
+    failed: int = 0
+    disallowed: int = 0
+    deduplicated: int = 0
+    bytes: int = 0
+    elapsed: float = 0.0
+
+    def summary(self) -> str:
+        elapsed = max(self.elapsed, 1e-6)
+        megabytes = self.bytes / (1024 * 1024)
+        return (f'{self.fetched} fetched ({self.deduplicated} duplicates), {self.skipped} skipped, {self.failed} failed, {self.disallowed} disallowed, '
+                f'{megabytes:.2f} MB in {self.elapsed:.2f}s '
+                f'({self.fetched / elapsed:.2f} docs/s, {megabytes / elapsed:.2f} MB/s)')
+
+class DownloadManifest(object):
+    """Validators of previously downloaded documents, keyed by docurl."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        if self.path.is_file():
+            with self.path.open() as fi:
+                self.entries = json.load(fi)
+            logging.info(f'Read {len(self.entries)} manifest entries from {self.path}')
+
+    def conditional_headers(self, docurl: str, outpath: Path, size: Optional[int]=None) -> Dict[str, str]:
+        """Validators of a downloaded doc, `size` is its known size on disk, otherwise the file is checked."""
+        with self.lock:
+            entry = self.entries.get(docurl)
+        if not entry or entry.get('size') != (outpath.stat().st_size if size is None else size):
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def record(self, docurl: str, headers, size: int, sha256: str) -> None:
+        entry = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'size': size,
+            'sha256': sha256,
+        }
+        with self.lock:
+            self.entries[docurl] = entry
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            content = json.dumps(self.entries, indent=4).encode()
+        write_atomic(self.path, [content])
+
+class ContentStore(object):
+    """Documents saved once under their SHA-256, with download paths linked to them.
+
+    The index maps each blob to the docurls and download paths sharing it, blobs no longer referenced by
+    any docurl are removed.
+    """
+
+    def __init__(self, rootdir, link='hardlink'):
+        self.rootdir = Path(rootdir)
+        self.link_mode = link
+        self.index_path = self.rootdir / 'index.json'
+        self.index: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        if self.index_path.is_file():
+            with self.index_path.open() as fi:
+                self.index = json.load(fi)
+            logging.info(f'Read {len(self.index)} stored documents from {self.index_path}')
+        self.docurls = {docurl: sha256 for sha256, entry in self.index.items() for docurl in entry['locations']}
+
+    def blob_path(self, sha256: str) -> Path:
+        return self.rootdir / sha256[:2] / sha256
+
+    def add(self, docurl: str, outpath: Path, sha256: str, size: int) -> bool:
+        """Replaces the downloaded `outpath` with a link to the blob of its content, returns whether the content was already stored."""
+        blob = self.blob_path(sha256)
+        with self.lock:
+            stored = sha256 in self.index and blob.is_file() and blob.stat().st_size == size
+            if not stored:
+                blob.parent.mkdir(parents=True, exist_ok=True)
+                self.move(outpath, blob)
+            self.link(blob, outpath)
+            previous = self.docurls.get(docurl)
+            if previous and previous != sha256:
+                self.unref(previous, docurl)
+            self.index.setdefault(sha256, {'size': size, 'locations': {}})['locations'][docurl] = str(outpath)
+            self.docurls[docurl] = sha256
+        return stored
+
+    def move(self, outpath: Path, blob: Path) -> None:
+        try:
+            os.replace(outpath, blob)
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+            # The store is on another filesystem: copy through a temporary file in the store instead.
+            with outpath.open('rb') as fi:
+                write_atomic(blob, iter(lambda: fi.read(CHUNK_SIZE), b''))
+            os.unlink(outpath)
+
+    def link(self, blob: Path, outpath: Path) -> None:
+        temppath = outpath.with_name(f'.{outpath.name}.link')
+        if op.lexists(temppath):
+            os.unlink(temppath)
+        try:
+            if self.link_mode != 'hardlink':
+                raise OSError('Symbolic link requested')
+            os.link(blob, temppath)
+        except OSError:
+            try:
+                os.symlink(blob.resolve(), temppath)
+            except OSError:
+                shutil.copyfile(blob, temppath)
+        os.replace(temppath, outpath)
+
+    def unref(self, sha256: str, docurl: str) -> None:
+        entry = self.index.get(sha256)
+        if not entry:
+            return
+        entry['locations'].pop(docurl, None)
+        if not entry['locations']:
+            del self.index[sha256]
+            blob = self.blob_path(sha256)
+            if blob.is_file():
+                os.unlink(blob)
+
+    def save(self) -> None:
+        self.rootdir.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            content = json.dumps(self.index, indent=4).encode()
+        write_atomic(self.index_path, [content])
+
+    def summary(self) -> str:
+        with self.lock:
+            locations = sum(len(entry['locations']) for entry in self.index.values())
+            megabytes = sum(entry['size'] for entry in self.index.values()) / (1024 * 1024)
+        return f'{len(self.index)} unique docs for {locations} docurls, {megabytes:.2f} MB'
+
+class LocationStore(object):
+    """Locations in an SQLite database indexed by docurl, docext and target, with the download status of their files.
+
+    Locations are inserted as they are located and committed in batches. The files table caches the path of each
+    location under a download directory, whether it was downloaded, its size and SHA-256, so inventories and
+    re-runs of large archives only check the disk for files not known to be downloaded. Files removed by other
+    tools are noticed again with `find_files(refresh=True)`.
+    """
+    COMMIT_INTERVAL = 500
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS locations (id INTEGER PRIMARY KEY, target TEXT, source TEXT, docurl TEXT, docext TEXT, extra TEXT)',
+        'CREATE INDEX IF NOT EXISTS locations_docurl ON locations (docurl)',
+        'CREATE INDEX IF NOT EXISTS locations_docext ON locations (docext)',
+        'CREATE INDEX IF NOT EXISTS locations_target ON locations (target)',
+        'CREATE TABLE IF NOT EXISTS files (outdir TEXT, docurl TEXT, docext TEXT, relpath TEXT, status TEXT, size INTEGER, sha256 TEXT, '
+        'PRIMARY KEY (outdir, docurl, docext))',
+        'CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)',
+    ]
+    UPSERT_FILE = ('INSERT INTO files (outdir, docurl, docext, relpath, status, size, sha256) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                   'ON CONFLICT (outdir, docurl, docext) DO UPDATE SET relpath = excluded.relpath, status = excluded.status, '
+                   'size = COALESCE(excluded.size, size), sha256 = COALESCE(excluded.sha256, sha256)')
+
+    def __init__(self, path, reset=False, readonly=False):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.pending = 0
+        if readonly:
+            self.db = sqlite3.connect(f'{self.path.resolve().as_uri()}?mode=ro', uri=True, check_same_thread=False)
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        for statement in LocationStore.SCHEMA:
+            self.db.execute(statement)
+        if reset:
+            # Download status outlives the locations so re-runs keep their inventory.
+            self.db.execute('DELETE FROM locations')
+        self.db.commit()
+
+    def __enter__(self) -> 'LocationStore':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def add(self, location: Location) -> None:
+        row = (location.target, location.source, location.docurl, location.docext, json.dumps(location.extra))
+        with self.lock:
+            self.db.execute('INSERT INTO locations (target, source, docurl, docext, extra) VALUES (?, ?, ?, ?, ?)', row)
+            self.written()
+
+    def record_file(self, outdir, location: Location, outpath: Path, size: Optional[int]=None, sha256: Optional[str]=None,
+                    status='downloaded') -> None:
+        row = (op.realpath(outdir), location.docurl, location.docext, op.relpath(outpath, outdir), status, size, sha256)
+        with self.lock:
+            self.db.execute(LocationStore.UPSERT_FILE, row)
+            self.written()
+
+    def get_file(self, outdir, location: Location) -> Optional[Tuple[str, str, Optional[int]]]:
+        """Cached relative path, status and size of the file of a location under `outdir`, None if never recorded."""
+        with self.lock:
+            return self.db.execute('SELECT relpath, status, size FROM files WHERE outdir = ? AND docurl = ? AND docext = ?',
+                                   (op.realpath(outdir), location.docurl, location.docext)).fetchone()
+
+    def written(self) -> None:
+        self.pending += 1
+        if self.pending >= LocationStore.COMMIT_INTERVAL:
+            self.db.commit()
+            self.pending = 0
+
+    def commit(self) -> None:
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self) -> None:
+        self.commit()
+        self.db.close()
+
+    @staticmethod
+    def get_filter(exts: Optional[List[str]], unique=False, alias='') -> Tuple[str, List[str]]:
+        clauses = []
+        params = []
+        if exts is not None:
+            clauses.append(f'{alias}docext IN ({", ".join("?" * len(exts))})')
+            params.extend(exts)
+        if unique:
+            clauses.append(f'{alias}id IN (SELECT MIN(id) FROM locations GROUP BY docurl)')
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def count(self, exts: Optional[List[str]]=None, unique=False) -> int:
+        where, params = LocationStore.get_filter(exts, unique)
+        with self.lock:
+            return self.db.execute(f'SELECT COUNT(*) FROM locations{where}', params).fetchone()[0]
+
+    def exts(self) -> List[str]:
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT DISTINCT docext FROM locations ORDER BY docext')]
+
+    def iter_locations(self, exts: Optional[List[str]]=None, unique=False) -> Iterator[Location]:
+        where, params = LocationStore.get_filter(exts, unique)
+        with self.lock:
+            cursor = self.db.execute(f'SELECT target, source, docurl, docext, extra FROM locations{where} ORDER BY id', params)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for target, source, docurl, docext, extra in rows:
+                yield Location(target, source, docurl, docext, json.loads(extra))
+
+    def find_files(self, outdir, exts: Optional[List[str]]=None, refresh=False) -> Dict[Path, List[Location]]:
+        """Locations by their downloaded file under `outdir`, only files not known to be downloaded are checked on disk."""
+        where, params = LocationStore.get_filter(exts, alias='l.')
+        query = ('SELECT l.target, l.source, l.docurl, l.docext, l.extra, f.relpath, f.status FROM locations l '
+                 f'LEFT JOIN files f ON f.outdir = ? AND f.docurl = l.docurl AND f.docext = l.docext{where} ORDER BY l.id')
+        with self.lock:
+            rows = self.db.execute(query, [op.realpath(outdir)] + params).fetchall()
+        files = {}
+        checked = {}
+        for target, source, docurl, docext, extra, relpath, status in rows:
+            location = Location(target, source, docurl, docext, json.loads(extra))
+            if status == 'downloaded' and not refresh:
+                outpath = Path(op.normpath(op.join(outdir, relpath)))
+            elif (docurl, docext) in checked:
+                outpath, status = checked[(docurl, docext)]
+            else:
+                outpath = location.outpath(outdir)
+                size = outpath.stat().st_size if outpath.is_file() else None
+                status = 'missing' if size is None else 'downloaded'
+                checked[(docurl, docext)] = (outpath, status)
+                self.record_file(outdir, location, outpath, size, status=status)
+            if status == 'downloaded':
+                files.setdefault(outpath, []).append(location)
+        self.commit()
+        return files
+
+    def find_duplicates(self) -> Dict[str, List[str]]:
+        """Docurls of downloaded files sharing their content, keyed by SHA-256."""
+        query = ('SELECT sha256, docurl FROM files WHERE sha256 IN '
+                 '(SELECT sha256 FROM files WHERE sha256 IS NOT NULL GROUP BY sha256 HAVING COUNT(DISTINCT docurl) > 1) ORDER BY sha256, docurl')
+        duplicates = {}
+        with self.lock:
+            for sha256, docurl in self.db.execute(query):
+                duplicates.setdefault(sha256, []).append(docurl)
+        return duplicates
+
+class BatchLocationStores(object):
+    """The location databases of batch targets, standing in for a LocationStore of the download engine.
+
+    Each located doc is routed to the database of the target that located it first, the download status
+    of docs located from targets without a database is not recorded.
+    """
+
+    def __init__(self):
+        self.stores: List[LocationStore] = []
+        self.routes: Dict[Tuple[str, str], LocationStore] = {}
+        self.lock = threading.Lock()
+
+    def open(self, target, exts, locate_outfile, locate_format='json') -> Optional[LocationStore]:
+        store = open_location_store(target, exts, locate_outfile, locate_format)
+        if store:
+            with self.lock:
+                self.stores.append(store)
+        return store
+
+    def route(self, location: Location, store: LocationStore) -> None:
+        with self.lock:
+            self.routes.setdefault((location.docurl, location.docext), store)
+
+    def get_file(self, outdir, location: Location) -> Optional[Tuple[str, str, Optional[int]]]:
+        store = self.routes.get((location.docurl, location.docext))
+        return store.get_file(outdir, location) if store else None
+
+    def record_file(self, outdir, location: Location, *args, **kwargs) -> None:
+        store = self.routes.get((location.docurl, location.docext))
+        if store:
+            store.record_file(outdir, location, *args, **kwargs)
+
+    def commit(self) -> None:
+        for store in self.stores:
+            store.commit()
+
+    def close(self) -> None:
+        for store in self.stores:
+            store.close()
+
+class RangesIgnoredError(IOError):
+    """The server answered a byte range request with the whole document."""
+
+class DownloadEngine(object):
+    LOOKAHEAD = 4
+    POLL_INTERVAL = 0.1
+    RANGE_SIZE = 8 * 1024 * 1024
+    def __init__(self, outdir, workers=1, host_limit=0, manifest: Optional[DownloadManifest]=None,
+                 store: Optional[ContentStore]=None, range_parts=1, range_threshold=0, get_outpath: Optional[Callable[[Location], Path]]=None,
+                 location_store: Optional[LocationStore]=None):
+        self.outdir = outdir
+        self.get_outpath = get_outpath or (lambda location: location.outpath(outdir))
+        self.workers = max(1, workers)
+        self.host_limit = host_limit
+        self.manifest = manifest
+        self.store = store
+        self.range_parts = range_parts
+        self.range_threshold = range_threshold
+        self.location_store = location_store
+        self.stats = DownloadStats()
+        self.lock = threading.Lock()
+        # Streams per host, a download counts once plus the extra byte ranges it fetches in parallel.
+        self.active: Dict[str, int] = Counter()
+        self.cancelled = threading.Event()
+
+    def run(self, locations: List[Location]) -> DownloadStats:
+        source = queue.Queue()
+        for location in locations:
+            source.put(location)
+        source.put(None)
+        return self.run_queue(source, len(locations))
+
+    def run_queue(self, source: queue.Queue, total: Optional[int]=None) -> DownloadStats:
+        """Downloads locations from `source` as they arrive until it yields None."""
+        start = time.monotonic()
+        try:
+            self.dispatch(source, total)
+        finally:
+            if self.manifest:
+                self.manifest.save()
+            if self.store:
+                self.store.save()
+            if self.location_store:
+                self.location_store.commit()
+        self.stats.elapsed = time.monotonic() - start
+        return self.stats
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def dispatch(self, source: queue.Queue, total: Optional[int]) -> None:
+        queues: Dict[str, Deque[Location]] = OrderedDict()
+        running = {}
+        num = 0
+        buffered = 0
+        exhausted = False
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not exhausted or queues or running:
+                if self.cancelled.is_set():
+                    exhausted = True
+                    queues.clear()
+                # Buffer a few locations per worker so busy hosts do not hold up the others.
+                while not exhausted and buffered < self.workers * DownloadEngine.LOOKAHEAD:
+                    try:
+                        location = source.get(block=not (queues or running), timeout=DownloadEngine.POLL_INTERVAL)
+                    except queue.Empty:
+                        break
+                    if location is None:
+                        exhausted = True
+                        break
+                    queues.setdefault(urlparse(location.docurl).netloc, deque()).append(location)
+                    buffered += 1
+                submitted = True
+                while submitted and len(running) < self.workers:
+                    submitted = False
+                    for host in list(queues):
+                        if len(running) >= self.workers:
+                            break
+                        if self.host_limit and self.active[host] >= self.host_limit:
+                            continue
+                        location = queues[host].popleft()
+                        if not queues[host]:
+                            del queues[host]
+                        buffered -= 1
+                        num += 1
+                        with self.lock:
+                            self.active[host] += 1
+                        running[executor.submit(self.fetch, location, num, total)] = host
+                        submitted = True
+                if not running:
+                    continue
+                done, _ = wait(running, timeout=None if exhausted else DownloadEngine.POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    with self.lock:
+                        self.active[running.pop(future)] -= 1
+
+    def fetch(self, location: Location, num: int, total: Optional[int]) -> None:
+        progress = f'{num} of {total}' if total else str(num)
+        try:
+            # Files recorded in the location database are not checked on disk again.
+            known = self.location_store.get_file(self.outdir, location) if self.location_store else None
+            if known:
+                relpath, status, size = known
+                outpath = Path(op.normpath(op.join(self.outdir, relpath)))
+                exists = status == 'downloaded'
+            else:
+                outpath = self.get_outpath(location)
+                exists = outpath.is_file()
+                size = None
+            headers = {}
+            if self.manifest and exists:
+                headers = self.manifest.conditional_headers(location.docurl, outpath, size)
+            if not is_allowed(location.docurl):
+                logging.info(f'Skipping doc {progress} disallowed by robots.txt: {location.docurl}')
+                with self.lock:
+                    self.stats.disallowed += 1
+                return
+            logging.info(f'Downloading doc {progress}: {outpath}')
+            with timed('download', location.docurl):
+                response = get_session().get(location.docurl, headers=headers, stream=True)
+                count_response(location.docurl, response)
+                if response.status_code == 304 and known and not outpath.is_file():
+                    # The cached status is only checked on disk when the server says the doc is unchanged.
+                    logging.info(f'Refetching doc {progress} missing from disk: {outpath}')
+                    response.close()
+                    response = get_session().get(location.docurl, stream=True)
+                    count_response(location.docurl, response)
+                with response:
+                    if response.status_code == 304:
+                        logging.info(f'Skipping unchanged doc {progress}: {outpath}')
+                        if self.location_store:
+                            self.location_store.record_file(self.outdir, location, outpath)
+                        with self.lock:
+                            self.stats.skipped += 1
+                        return
+                    response.raise_for_status()
+                    outpath.parent.mkdir(parents=True, exist_ok=True)
+                    if self.can_split(response):
+                        response.close()
+                        host = urlparse(location.docurl).netloc
+                        extra = self.reserve_streams(host)
+                        try:
+                            size, sha256 = self.fetch_ranges(location.docurl, outpath, response.headers, 1 + extra)
+                        except RangesIgnoredError as exc:
+                            logging.warning(f'{exc}, downloading doc {progress} in a single stream: {outpath}')
+                            size, sha256 = self.fetch_stream(location.docurl, outpath)
+                        finally:
+                            with self.lock:
+                                self.active[host] -= extra
+                    else:
+                        digest = hashlib.sha256()
+                        size = write_atomic(outpath, response.iter_content(CHUNK_SIZE), digest)
+                        sha256 = digest.hexdigest()
+            duplicate = False
+            if self.store:
+                duplicate = self.store.add(location.docurl, outpath, sha256, size)
+            if self.manifest:
+                self.manifest.record(location.docurl, response.headers, size, sha256)
+            if self.location_store:
+                self.location_store.record_file(self.outdir, location, outpath, size, sha256)
+            count_metric('bytes_total', size, host=get_host(location.docurl), kind='document')
+            with self.lock:
+                self.stats.fetched += 1
+                self.stats.deduplicated += duplicate
+                self.stats.bytes += size
+        except Exception:
+            logging.error(f'Could not download/write {location.docurl}')
+            with self.lock:
+                self.stats.failed += 1
+
+    def can_split(self, response) -> bool:
+        size = int(response.headers.get('Content-Length') or 0)
+        return (self.range_parts > 1 and response.status_code == 200 and size >= max(self.range_threshold, 1)
+                and response.headers.get('Accept-Ranges', '').lower() == 'bytes' and 'Content-Encoding' not in response.headers)
+
+    def reserve_streams(self, host: str) -> int:
+        """Counts the extra range streams of a download against the host limit, returns how many it may open."""
+        with self.lock:
+            extra = self.range_parts - 1
+            if self.host_limit:
+                extra = max(0, min(extra, self.host_limit - self.active[host]))
+            self.active[host] += extra
+        return extra
+
+    def fetch_stream(self, docurl: str, outpath: Path) -> Tuple[int, str]:
+        with get_session().get(docurl, stream=True) as response:
+            count_response(docurl, response)
+            response.raise_for_status()
+            digest = hashlib.sha256()
+            size = write_atomic(outpath, response.iter_content(CHUNK_SIZE), digest)
+        return size, digest.hexdigest()
+
+    def fetch_ranges(self, docurl: str, outpath: Path, headers, parts: int) -> Tuple[int, str]:
+        """Fetches a document in byte ranges on up to `parts` parallel streams into a preallocated .part file, returns its size and SHA-256.
+
+        Completed ranges are recorded next to the .part file, so an interrupted download resumes with the
+        missing ranges as long as the document's validator is unchanged. Weak ETags cannot validate ranges,
+        Last-Modified is used instead. Raises RangesIgnoredError when the server sends the whole document.
+        """
+        size = int(headers['Content-Length'])
+        etag = headers.get('ETag') or ''
+        validator = (etag if not etag.startswith('W/') else '') or headers.get('Last-Modified') or ''
+        partpath = outpath.with_name(f'{outpath.name}.part')
+        statepath = outpath.with_name(f'{outpath.name}.part.json')
+        state = {'docurl': docurl, 'size': size, 'validator': validator, 'done': []}
+        if validator and partpath.is_file() and statepath.is_file():
+            with statepath.open() as fi:
+                saved = json.load(fi)
+            if [saved.get(key) for key in ['docurl', 'size', 'validator']] == [docurl, size, validator]:
+                state['done'] = saved['done']
+                logging.info(f'Resuming download with {len(state["done"])} ranges on disk: {outpath}')
+        if not state['done']:
+            with partpath.open('wb') as fo:
+                fo.truncate(size)
+        ranges = [(start, min(start + DownloadEngine.RANGE_SIZE, size) - 1) for start in range(0, size, DownloadEngine.RANGE_SIZE) if start not in state['done']]
+        lock = threading.Lock()
+        def _fetch_range(start, end):
+            range_headers = {'Range': f'bytes={start}-{end}'}
+            if validator:
+                range_headers['If-Range'] = validator
+            with get_session().get(docurl, headers=range_headers, stream=True) as response:
+                count_response(docurl, response)
+                content_range = response.headers.get('Content-Range', '')
+                if response.status_code == 200:
+                    raise RangesIgnoredError(f'Server ignored the byte ranges of {docurl}')
+                if response.status_code != 206 or not content_range.startswith(f'bytes {start}-{end}/'):
+                    raise IOError(f'Expected bytes {start}-{end} of {docurl}, got status {response.status_code} {content_range}')
+                written = 0
+                with partpath.open('r+b') as fo:
+                    fo.seek(start)
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        fo.write(chunk)
+                        written += len(chunk)
+            if written != end - start + 1:
+                raise IOError(f'Received {written} of {end - start + 1} bytes at offset {start} of {docurl}')
+            with lock:
+                state['done'].append(start)
+                write_atomic(statepath, [json.dumps(state).encode()])
+        try:
+            with ThreadPoolExecutor(max_workers=parts) as executor:
+                futures = [executor.submit(_fetch_range, start, end) for start, end in ranges]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        except RangesIgnoredError:
+            for path in [partpath, statepath]:
+                if path.exists():
+                    os.unlink(path)
+            raise
+        digest = hashlib.sha256()
+        with partpath.open('rb') as fi:
+            for chunk in iter(lambda: fi.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        expected = get_expected_digest(headers)
+        if partpath.stat().st_size != size or (expected and expected != digest.digest()):
+            os.unlink(partpath)
+            os.unlink(statepath)
+            raise IOError(f'Size or hash mismatch of ranged download: {docurl}')
+        os.replace(partpath, outpath)
+        os.unlink(statepath)
+        return size, digest.hexdigest()
+
+class DownloadPipeline(object):
+    """Downloads locations while they are still being located.
+
+    Locators hand locations to `put`, which drops already queued docurls and blocks while the bounded queue
+    is full, so a crawl cannot run arbitrarily far ahead of the downloads.
+    """
+    QUEUE_SIZE = 1024
+    def __init__(self, engine: DownloadEngine):
+        self.engine = engine
+        self.queue = queue.Queue(maxsize=DownloadPipeline.QUEUE_SIZE)
+        self.docurls: Set[str] = set()
+        self.lock = threading.Lock()
+        self.stats: Optional[DownloadStats] = None
+        self.thread = threading.Thread(target=self.consume, name='download-pipeline', daemon=True)
+
+    def __enter__(self) -> 'DownloadPipeline':
+        logging.info(f'Starting pipelined download with {self.engine.workers} workers')
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if not exc_type:
+            self.send(None)
+            self.thread.join()
+            return
+        # The cancelled engine stops reading, so make room for the end marker instead of waiting on a full queue.
+        self.engine.cancel()
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self.thread.join()
+
+    def consume(self) -> None:
+        try:
+            self.stats = self.engine.run_queue(self.queue)
+        except Exception:
+            logging.exception('Download pipeline stopped unexpectedly')
+
+    def get_stats(self) -> DownloadStats:
+        """Stats of the finished pipeline, or of the downloads completed before it stopped unexpectedly."""
+        if self.stats is None:
+            logging.error('Download pipeline stopped unexpectedly, stats only cover the downloads completed before it stopped')
+            return self.engine.stats
+        return self.stats
+
+    def put(self, location: Location) -> None:
+        with self.lock:
+            if location.docurl in self.docurls:
+                return
+            self.docurls.add(location.docurl)
+        self.send(location)
+
+    def send(self, item: Optional[Location]) -> None:
+        while True:
+            try:
+                self.queue.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                if not self.thread.is_alive():
+                    raise RuntimeError('Download pipeline stopped unexpectedly')
+
+class Metrics(object):
+    """Counters and latency histograms of a run, labelled by phase and host."""
+    BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+    HELP = {
+        'phase_seconds': 'Latency of each phase of a run.',
+        'bytes_total': 'Bytes transferred.',
+        'responses_total': 'HTTP responses by status code.',
+        'retries_total': 'HTTP request retries.',
+        'connections_total': 'New HTTP connections.',
+        'pages_dropped_total': 'Crawled pages dropped for not being HTML or for their size.',
+        'throttles_total': 'Halvings of the per-host concurrency after errors, throttling or slow responses.',
+    }
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = Counter()
+        self.histograms: Dict[Tuple[str, str], List[float]] = {}
+
+    def count(self, name: str, amount: float=1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += amount
+
+    def observe(self, phase: str, seconds: float, host: str='') -> None:
+        index = next((index for index, bound in enumerate(Metrics.BUCKETS) if seconds <= bound), len(Metrics.BUCKETS))
+        with self.lock:
+            histogram = self.histograms.setdefault((phase, host), [0.0] * (len(Metrics.BUCKETS) + 3))
+            histogram[index] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    @contextmanager
+    def timer(self, phase: str, host: str=''):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start, host)
+
+    def to_json(self) -> Dict[str, Any]:
+        with self.lock:
+            counters = [dict(labels, name=name, value=value) for (name, labels), value in sorted(self.counters.items())]
+            histograms = []
+            for (phase, host), histogram in sorted(self.histograms.items()):
+                buckets = dict(zip([str(bound) for bound in Metrics.BUCKETS] + ['+Inf'], histogram[:-2]))
+                histograms.append({'phase': phase, 'host': host, 'count': int(histogram[-2]), 'sum': histogram[-1], 'buckets': buckets})
+        return {'started': self.started, 'elapsed': time.time() - self.started, 'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self, prefix='documentsdownloader') -> str:
+        _format_labels = lambda labels: ','.join(f'{key}="{value}"' for key, value in labels)
+        lines = []
+        with self.lock:
+            names = sorted(set(name for name, _ in self.counters))
+            for name in names:
+                lines.append(f'# HELP {prefix}_{name} {Metrics.HELP.get(name, name)}')
+                lines.append(f'# TYPE {prefix}_{name} counter')
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f'{prefix}_{name}{{{_format_labels(labels)}}} {value}')
+            if self.histograms:
+                lines.append(f'# HELP {prefix}_phase_seconds {Metrics.HELP["phase_seconds"]}')
+                lines.append(f'# TYPE {prefix}_phase_seconds histogram')
+            for (phase, host), histogram in sorted(self.histograms.items()):
+                labels = _format_labels([('phase', phase), ('host', host)])
+                cumulative = 0
+                for bound, observed in zip([str(bound) for bound in Metrics.BUCKETS] + ['+Inf'], histogram[:-2]):
+                    cumulative += observed
+                    lines.append(f'{prefix}_phase_seconds_bucket{{{labels},le="{bound}"}} {int(cumulative)}')
+                lines.append(f'{prefix}_phase_seconds_sum{{{labels}}} {histogram[-1]}')
+                lines.append(f'{prefix}_phase_seconds_count{{{labels}}} {int(histogram[-2])}')
+        return '\n'.join(lines) + '\n'
+
+@dataclass
+class HostState:
+    limit: float = 1.0
+    active: int = 0
+    delay: float = 0.0
+    next_start: float = 0.0
+    blocked_until: float = 0.0
+    best_latency: float = 0.0
+    decreased: float = 0.0
+
+class HostScheduler(object):
+    """Per-host politeness: robots.txt rules and Crawl-delay, Retry-After backoff and adaptive concurrency.
+
+    Concurrency per host follows additive increase, multiplicative decrease. It grows by one request per
+    window of successful responses up to `max_concurrency`, and halves on 429/5xx responses, connection
+    errors and latencies well above the best seen for the host.
+    """
+    INITIAL_LIMIT = 2
+    LATENCY_FACTOR = 3.0
+    LATENCY_SLACK = 0.25
+    MAX_RETRY_AFTER = 300.0
+    def __init__(self, robots=True, max_concurrency=8, min_delay=0.0):
+        self.robots = robots
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_delay = min_delay
+        self.hosts: Dict[str, HostState] = {}
+        self.rules: Dict[str, RobotFileParser] = {}
+        self.rules_locks: Dict[str, threading.RLock] = {}
+        self.loading: Set[str] = set()
+        self.condition = threading.Condition()
+
+    def get_state(self, host: str) -> HostState:
+        state = self.hosts.get(host)
+        if not state:
+            state = self.hosts[host] = HostState(limit=min(HostScheduler.INITIAL_LIMIT, self.max_concurrency), delay=self.min_delay)
+        return state
+
+    def get_rules(self, url: str) -> Optional[RobotFileParser]:
+        if not self.robots:
+            return None
+        parsed = urlparse(url)
+        origin = urlunsplit([parsed.scheme, parsed.netloc, '', '', ''])
+        with self.condition:
+            lock = self.rules_locks.setdefault(origin, threading.RLock())
+        with lock:
+            if origin in self.loading:
+                # A redirect of robots.txt back to its own site, fetch it unscheduled.
+                return None
+            if origin not in self.rules:
+                self.loading.add(origin)
+                try:
+                    rules = self.rules[origin] = HostScheduler.fetch_rules(origin)
+                finally:
+                    self.loading.discard(origin)
+                useragent = get_session().headers.get('User-Agent', '*')
+                delay = rules.crawl_delay(useragent) or 0.0
+                rate = rules.request_rate(useragent)
+                if rate and rate.requests:
+                    delay = max(delay, rate.seconds / rate.requests)
+                if delay:
+                    logging.info(f'Honoring robots.txt delay of {delay}s between requests to {origin}')
+                with self.condition:
+                    state = self.get_state(get_host(url))
+                    state.delay = max(state.delay, float(delay))
+        return self.rules[origin]
+
+    @staticmethod
+    def fetch_rules(origin: str) -> RobotFileParser:
+        rules = RobotFileParser(f'{origin}/robots.txt')
+        try:
+            response = get_session().get(f'{origin}/robots.txt')
+        except Exception:
+            logging.warning(f'Could not retrieve {origin}/robots.txt, allowing all URLs')
+            rules.allow_all = True
+            return rules
+        if response.status_code in (401, 403):
+            rules.disallow_all = True
+        elif response.status_code >= 400:
+            rules.allow_all = True
+        else:
+            rules.parse(response.text.splitlines())
+        return rules
+
+    def is_allowed(self, url: str) -> bool:
+        rules = self.get_rules(url)
+        return not rules or rules.can_fetch(get_session().headers.get('User-Agent', '*'), url)
+
+    def acquire(self, url: str) -> float:
+        """Blocks until the host of the URL may take another request, returns the start time of the request."""
+        self.get_rules(url)
+        with self.condition:
+            state = self.get_state(get_host(url))
+            while True:
+                now = time.monotonic()
+                wait = max(state.blocked_until, state.next_start) - now
+                if wait <= 0 and state.active < int(state.limit):
+                    break
+                self.condition.wait(wait if wait > 0 else None)
+            state.active += 1
+            state.next_start = now + state.delay
+        return now
+
+    def release(self, url: str, start: float, response=None, latency: Optional[float]=None) -> None:
+        """Frees the host slot of a request once its body is read and adapts the host concurrency to its outcome.
+
+        `response` is None on connection errors, `latency` is the time until the response headers arrived and
+        defaults to the time since `start`, so that large bodies are not mistaken for an overloaded host.
+        """
+        host = get_host(url)
+        with self.condition:
+            state = self.get_state(host)
+            state.active -= 1
+            now = time.monotonic()
+            status = response.status_code if response is not None else None
+            if status in (429, 503):
+                self.block(state, parse_retry_after(response.headers.get('Retry-After')), now)
+            overloaded = status is None or status == 429 or status >= 500
+            if not overloaded:
+                if latency is None:
+                    latency = now - start
+                state.best_latency = min(state.best_latency, latency) if state.best_latency else latency
+                overloaded = latency > state.best_latency * HostScheduler.LATENCY_FACTOR + HostScheduler.LATENCY_SLACK
+            if overloaded:
+                self.decrease(host, state, now)
+            else:
+                state.limit = min(self.max_concurrency, state.limit + 1 / state.limit)
+            self.condition.notify_all()
+
+    def penalize(self, host: str, retry_after: Optional[float]) -> None:
+        """Backs off a host that throttled a request which is being retried."""
+        with self.condition:
+            state = self.get_state(host)
+            now = time.monotonic()
+            self.block(state, retry_after, now)
+            self.decrease(host, state, now)
+            self.condition.notify_all()
+
+    @staticmethod
+    def block(state: HostState, retry_after: Optional[float], now: float) -> None:
+        if retry_after:
+            state.blocked_until = max(state.blocked_until, now + min(retry_after, HostScheduler.MAX_RETRY_AFTER))
+
+    @staticmethod
+    def decrease(host: str, state: HostState, now: float) -> None:
+        # Halve at most once per second so a burst of failures from one window counts once.
+        if now - state.decreased < 1.0:
+            return
+        state.limit = max(1.0, state.limit / 2)
+        state.decreased = now
+        count_metric('throttles_total', host=host)
+
+class CountingRetry(Retry):
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        host = _pool.host if _pool else ''
+        count_metric('retries_total', host=host)
+        if SCHEDULER and response is not None and response.status in (429, 503):
+            SCHEDULER.penalize(host, parse_retry_after(response.headers.get('Retry-After')))
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        with timed('connect', host=self.host):
+            super().connect()
+        count_metric('connections_total', host=self.host)
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        with timed('connect', host=self.host):
+            super().connect()
+        count_metric('connections_total', host=self.host)
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        scheduler = SCHEDULER
+        if not scheduler or urlparse(request.url).path == '/robots.txt':
+            return super().send(request, **kwargs)
+        start = scheduler.acquire(request.url)
+        try:
+            response = super().send(request, **kwargs)
+        except BaseException:
+            scheduler.release(request.url, start)
+            raise
+        latency = time.monotonic() - start
+        # Hold the host slot until the body has been read or the response closed, not only until the headers arrived.
+        release_conn = response.raw.release_conn
+        once = threading.Lock()
+        def _release_conn():
+            if once.acquire(blocking=False):
+                scheduler.release(request.url, start, response, latency)
+            release_conn()
+        response.raw.release_conn = _release_conn
+        return response
+
+class PageCache(object):
+    """Crawled page bodies and their validators, stored as `{key}.body` and `{key}.json` files."""
+
+    def __init__(self, cachedir, max_size=0, max_age=0.0):
+        self.cachedir = Path(cachedir)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.sizes: Dict[str, int] = {}
+        self.cachedir.mkdir(parents=True, exist_ok=True)
+        for entry in os.scandir(self.cachedir):
+            if entry.name.endswith('.body'):
+                self.sizes[entry.name[:-len('.body')]] = entry.stat().st_size
+        self.evict()
+
+    @staticmethod
+    def get_key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def read_meta(self, url: str) -> Optional[Dict[str, Any]]:
+        key = PageCache.get_key(url)
+        try:
+            with (self.cachedir / f'{key}.json').open() as fi:
+                meta = json.load(fi)
+        except (IOError, ValueError):
+            return None
+        if self.max_age and time.time() - meta['stored'] > self.max_age:
+            self.remove(key)
+            return None
+        return meta
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        meta = self.read_meta(url)
+        headers = {}
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def load(self, url: str) -> Optional[bytes]:
+        key = PageCache.get_key(url)
+        try:
+            bodypath = self.cachedir / f'{key}.body'
+            content = bodypath.read_bytes()
+            os.utime(bodypath)
+        except IOError:
+            return None
+        with self.lock:
+            self.hits += 1
+        return content
+
+    def store(self, url: str, headers, content: bytes) -> None:
+        with self.lock:
+            self.misses += 1
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        key = PageCache.get_key(url)
+        meta = {'url': url, 'etag': etag, 'last_modified': last_modified, 'stored': time.time()}
+        write_atomic(self.cachedir / f'{key}.body', [content])
+        write_atomic(self.cachedir / f'{key}.json', [json.dumps(meta).encode()])
+        with self.lock:
+            self.sizes[key] = len(content)
+        self.evict()
+
+    def remove(self, key: str) -> None:
+        with self.lock:
+            self.sizes.pop(key, None)
+        for suffix in ['.body', '.json']:
+            try:
+                os.unlink(self.cachedir / f'{key}{suffix}')
+            except FileNotFoundError:
+                pass
+
+    def evict(self) -> None:
+        with self.lock:
+            total = sum(self.sizes.values())
+            keys = list(self.sizes)
+        if not self.max_size or total <= self.max_size:
+            return
+        def _atime(key):
+            try:
+                return (self.cachedir / f'{key}.body').stat().st_mtime
+            except FileNotFoundError:
+                return 0.0
+        for key in sorted(keys, key=_atime):
+            if total <= self.max_size:
+                break
+            total -= self.sizes.get(key, 0)
+            self.remove(key)
+
+    def summary(self) -> str:
+        return f'{self.hits} hits, {self.misses} misses, {len(self.sizes)} cached pages'
+
 ##==============================================================#
 ## SECTION: Function Definitions                                #
 ##==============================================================#
@@ -239,25 +1836,45 @@ def is_crawl_loop(url: str, repeat_limit: int=3) -> bool:
         prev = seg
     return False
 
-def find_all_exts(locate_outfile: str) -> List[str]:
-    exts = set()
+def is_location_db(path: str) -> bool:
+    return op.splitext(path)[1].lower() in LOCATION_DB_EXTS
+
+def read_locations(locate_outfile: str) -> Iterator[Location]:
+    if is_location_db(locate_outfile):
+        with LocationStore(locate_outfile, readonly=True) as store:
+            yield from store.iter_locations()
+        return
     with open(locate_outfile) as fi:
-        for locdata in json.load(fi):
-            exts.add(locdata['docext'])
-    return sorted(exts)
+        if locate_outfile.endswith('.jsonl'):
+            for line in fi:
+                if line.strip():
+                    yield Location(**json.loads(line))
+        else:
+            for locdata in json.load(fi):
+                yield Location(**locdata)
+
+def find_all_exts(locate_outfile: str) -> List[str]:
+    if is_location_db(locate_outfile):
+        with LocationStore(locate_outfile, readonly=True) as store:
+            return store.exts()
+    return sorted(set(location.docext for location in read_locations(locate_outfile)))
 
-def find_files(locate_outfile: str, download_outdir: str, exts: List[str]=[]) -> Dict[Path, List[Location]]:
+def find_files(locate_outfile: str, download_outdir: str, exts: List[str]=[], refresh=False) -> Dict[Path, List[Location]]:
     if not op.isfile(locate_outfile):
         logging.error(f'Could not find location file: {locate_outfile}')
         return {}
     if not op.isdir(download_outdir):
         logging.error(f'Could not find download output directory: {download_outdir}')
         return {}
-    if not exts:
-        exts = find_all_exts(locate_outfile)
-    locator = JsonLocator(locate_outfile, exts)
+    if is_location_db(locate_outfile):
+        with LocationStore(locate_outfile) as store:
+            return store.find_files(download_outdir, exts or None, refresh)
+    locator = JsonLocator(locate_outfile, exts or None, lazy=True)
+    return get_existing_files(locator.iter_locations(), download_outdir)
+
+def get_existing_files(locations: Iterable[Location], download_outdir: str) -> Dict[Path, List[Location]]:
     files = {}
-    for location in locator.locations:
+    for location in locations:
         outpath = location.outpath(download_outdir)
         if outpath.exists():
             files.setdefault(outpath, [])
@@ -282,39 +1899,360 @@ def to_absolute_url(parsed_base: ParseResult, parsed_url: ParseResult) -> str:
         return _format_url(path)
     return parsed_url.geturl().strip()
 
+def iter_sitemap(url: str) -> Iterator[Tuple[str, str]]:
+    """Streams the URLs of a sitemap or sitemap index, gzipped or not, as (`sitemap` or `url`, URL) pairs."""
+    try:
+        with timed('sitemap', url), get_session().get(url, stream=True) as response:
+            count_response(url, response)
+            if response.status_code != 200:
+                logging.info(f'No sitemap at URL: {url}')
+                return
+            response.raw.decode_content = True
+            response.raw.auto_close = False
+            stream = io.BufferedReader(response.raw, CHUNK_SIZE)
+            if stream.peek(2)[:2] == b'\x1f\x8b':
+                stream = gzip.GzipFile(fileobj=stream)
+            kind = None
+            root = None
+            for event, elem in ET.iterparse(stream, events=('start', 'end')):
+                tag = elem.tag.rpartition('}')[2]
+                if event == 'start':
+                    if root is None:
+                        root = elem
+                        kind = 'sitemap' if tag == 'sitemapindex' else 'url'
+                    continue
+                if tag == 'loc' and elem.text and elem.text.strip():
+                    yield kind, elem.text.strip()
+                elif tag in ('url', 'sitemap'):
+                    # Drop finished entries so memory stays flat on large sitemaps.
+                    root.clear()
+    except (requests.RequestException, ET.ParseError, OSError, EOFError) as exc:
+        logging.warning(f'Could not read sitemap at URL: {url} ({exc})')
+
+def canonicalize_url(url: str) -> str:
+    """Normalizes a URL so the variants a site links to the same page under collapse to one frontier entry.
+
+    Lowercases the scheme and host, drops default ports, fragments, dot segments and trailing slashes, and
+    sorts the query parameters.
+    """
+    parsed = urlparse(url.strip())
+    scheme = parsed.scheme.lower()
+    host = parsed.hostname or ''
+    if ':' in host:
+        host = f'[{host}]'
+    try:
+        port = parsed.port
+    except ValueError:
+        port = None
+    netloc = host if port is None or port == DEFAULT_PORTS.get(scheme) else f'{host}:{port}'
+    userinfo = parsed.netloc.rpartition('@')[0]
+    if userinfo:
+        netloc = f'{userinfo}@{netloc}'
+    path = '/'
+    if parsed.path.strip('/'):
+        path = '/' + posixpath.normpath(parsed.path).lstrip('/')
+    query = '&'.join(sorted(param for param in parsed.query.split('&') if param))
+    return urlunparse([scheme, netloc, path, parsed.params, query, ''])
+
 def remove_scheme(url: str) -> str:
     parsed = urlparse(url)
     return urlunsplit(['', parsed.netloc, parsed.path, '', ''])
 
-def get_soup(url: str, debug=False) -> BeautifulSoup:
+def is_html_response(content_type: str, head: bytes) -> bool:
+    """Decides from the Content-Type and the first bytes of a body whether it is an HTML page."""
+    if content_type in HTML_CONTENT_TYPES:
+        return True
+    if content_type not in GENERIC_CONTENT_TYPES:
+        return False
+    head = head[:1024].lstrip().lower()
+    return head.startswith(b'<!doctype html') or any(tag in head for tag in [b'<html', b'<head', b'<body'])
+
+def fetch_page(url: str, sniff=False, max_size=MAX_PAGE_SIZE, debug=False) -> Tuple[Optional[bool], Optional[bytes]]:
+    """Fetches a page in one streamed GET, returns whether it is HTML, None if it could not be fetched, and its content.
+
+    With `sniff`, non-HTML responses are dropped after their first bytes. Bodies over `max_size` bytes are
+    dropped as soon as they grow past it, the content is None for dropped and failed pages.
+    """
     try:
-        response = requests.get(url)
-        if response.status_code == 404:
-            logging.warning(f'Page not found: {url}')
-            return
-        if response.status_code >= 400:
-            logging.warning(f'Bad response: {url}')
-            return
-        content = response.content
-        if debug:
-            Path('__debug__').mkdir(parents=True, exist_ok=True)
-            dbgpath = f'__debug__/visited_content-{sanitize_filename(url)}.html'
-            with open(dbgpath, 'w') as fo:
-                fo.write(str(content))
-        return BeautifulSoup(content, 'html.parser')
+        headers = PAGE_CACHE.conditional_headers(url) if PAGE_CACHE else {}
+        with timed('fetch', url):
+            response = get_session().get(url, headers=headers, stream=True)
+            if response.status_code == 304 and PAGE_CACHE:
+                response.close()
+                content = PAGE_CACHE.load(url)
+                count_response(url, response)
+                if content is not None:
+                    return True, write_debug_page(url, content, debug)
+                response = get_session().get(url, stream=True)
+            with response:
+                count_response(url, response)
+                if response.status_code == 404:
+                    logging.warning(f'Page not found: {url}')
+                    return None, None
+                if response.status_code >= 400:
+                    logging.warning(f'Bad response: {url}')
+                    return None, None
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                chunks = response.iter_content(CHUNK_SIZE)
+                content = next(chunks, b'')
+                if sniff and not is_html_response(content_type, content):
+                    logging.info(f'Skipping non-HTML content ({content_type or "unknown type"}) of URL: {url}')
+                    count_metric('pages_dropped_total', host=get_host(url), reason='type')
+                    return False, None
+                if int(response.headers.get('Content-Length') or 0) <= max_size:
+                    content = bytearray(content)
+                    for chunk in chunks:
+                        content += chunk
+                        if len(content) > max_size:
+                            break
+                if len(content) > max_size or int(response.headers.get('Content-Length') or 0) > max_size:
+                    logging.warning(f'Skipping page larger than {max_size} bytes: {url}')
+                    count_metric('pages_dropped_total', host=get_host(url), reason='size')
+                    return True, None
+                content = bytes(content)
+        count_metric('bytes_total', len(content), host=get_host(url), kind='page')
+        if PAGE_CACHE:
+            PAGE_CACHE.store(url, response.headers, content)
+        return True, write_debug_page(url, content, debug)
     except IOError:
         logging.error(f'Could not retrieve content from URL: {url}')
+        return None, None
+
+def write_debug_page(url: str, content: bytes, debug=False) -> bytes:
+    if debug:
+        Path('__debug__').mkdir(parents=True, exist_ok=True)
+        dbgpath = f'__debug__/visited_content-{sanitize_filename(url)}.html'
+        with open(dbgpath, 'w') as fo:
+            fo.write(str(content))
+    return content
+
+def get_page(url: str, debug=False) -> Optional[bytes]:
+    return fetch_page(url, debug=debug)[1]
+
+def get_soup(url: str, debug=False) -> BeautifulSoup:
+    content = get_page(url, debug)
+    if content is not None:
+        with timed('parse', url):
+            return BeautifulSoup(content, 'html.parser')
+
+def fingerprint(content: bytes) -> str:
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+def simhash(features: Iterable[str]) -> int:
+    weights = [0] * 64
+    for feature in features:
+        hashed = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'big')
+        for bit in range(64):
+            weights[bit] += 1 if (hashed >> bit) & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+def get_link_features(linkurls: List[str]) -> Set[str]:
+    """Link paths without queries or fragments, so session IDs do not hide duplicate pages."""
+    return set(urlparse(linkurl).path for linkurl in linkurls)
+
+def decode_html(content: bytes) -> str:
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return UnicodeDammit(content, is_html=True).unicode_markup
+
+def extract_hrefs(content: bytes, parser='html.parser') -> List[str]:
+    if parser == 'lxml' and lxml:
+        try:
+            root = lxml.html.document_fromstring(decode_html(content))
+            return [tag.get('href') for tag in root.iter('a') if tag.get('href')]
+        except lxml.etree.ParserError:
+            return []
+        except ValueError:
+            # lxml refuses decoded text with an XML encoding declaration, the builtin parser does not care.
+            pass
+    extractor = LinkExtractor()
+    extractor.feed(decode_html(content))
+    extractor.close()
+    return extractor.hrefs
+
+def extract_links(url: str, content: bytes, exts: List[str], parser='html.parser') -> Tuple[List[str], List[str]]:
+    """Returns the absolute URLs of linked documents matching exts and of all links on a page."""
+    parsed_url = urlparse(url)
+    docurls = []
+    linkurls = []
+    for href in extract_hrefs(content, parser):
+        linkurl = to_absolute_url(parsed_url, urlparse(href))
+        linkurls.append(linkurl)
+        lowered = href.lower()
+        if any(ext in lowered for ext in exts):
+            docext = op.splitext(urlparse(linkurl).path)[1].lower()
+            if docext in exts:
+                docurls.append(linkurl)
+    return docurls, linkurls
+
+def parse_page(url: str, content: bytes, exts: List[str], scope: str, parser='html.parser', signature=False,
+               pagehash: Optional[str]=None) -> ParsedPage:
+    """Parses a crawled page, runs in worker processes so it must only depend on its arguments."""
+    docurls, linkurls = extract_links(url, content, exts, parser)
+    childurls = []
+    for linkurl in linkurls:
+        linkurl = canonicalize_url(linkurl)
+        if WebLocator.is_subpage(scope, linkurl):
+            childurls.append(linkurl)
+    return ParsedPage(pagehash or fingerprint(content), docurls, childurls, simhash(get_link_features(linkurls)) if signature else None)
+
+def find_page_docs(url: str) -> Tuple[Location, ...]:
+    """Locations of the docs of every doctype linked from a page, reused for `PAGE_DOCS_TTL` seconds after the page is fetched."""
+    now = time.monotonic()
+    with PAGE_DOCS_LOCK:
+        cached = PAGE_DOCS.get(url)
+    if cached and now - cached[0] < PAGE_DOCS_TTL:
+        return cached[1]
+    content = get_page(url)
+    if content is None:
+        raise IOError(f'Could not retrieve page: {url}')
+    docurls, _ = extract_links(url, content, get_all_doctype_exts())
+    locations = tuple(Location(url, url, docurl, op.splitext(urlparse(docurl).path)[1].lower()) for docurl in dict.fromkeys(docurls))
+    with PAGE_DOCS_LOCK:
+        PAGE_DOCS[url] = (now, locations)
+        PAGE_DOCS.move_to_end(url)
+        while len(PAGE_DOCS) > PAGE_DOCS_LIMIT:
+            PAGE_DOCS.popitem(last=False)
+    return locations
+
+def download_page_docs(url: str, doctypes: List[str], outdir, workers=4) -> DownloadStats:
+    """Downloads the docs of given doctypes linked from a page into `outdir`, named after the last segment of their URL.
+
+    The page is fetched and parsed once for every doctype requested within `PAGE_DOCS_TTL` seconds, downloads
+    stream to disk concurrently.
+    """
+    exts = get_extensions(doctypes, [])
+    try:
+        locations = [location for location in find_page_docs(url) if location.docext in exts]
+    except IOError as exc:
+        logging.error(str(exc))
+        return DownloadStats()
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    _get_outpath = lambda location: Path(outdir, sanitize_filename(urlparse(location.docurl).path.split('/')[-1]))
+    engine = DownloadEngine(outdir, workers, get_outpath=_get_outpath)
+    return engine.run(locations)
+
+def configure_metrics(enabled: bool) -> Optional[Metrics]:
+    global METRICS
+    METRICS = Metrics() if enabled else None
+    return METRICS
+
+def write_metrics(metrics_json='', metrics_prometheus='') -> None:
+    if not METRICS:
+        return
+    if metrics_json:
+        logging.info(f'Writing run metrics to {metrics_json}')
+        Path(metrics_json).parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(Path(metrics_json), [json.dumps(METRICS.to_json(), indent=4).encode()])
+    if metrics_prometheus:
+        logging.info(f'Writing run metrics to {metrics_prometheus}')
+        Path(metrics_prometheus).parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(Path(metrics_prometheus), [METRICS.to_prometheus().encode()])
+
+def get_host(url: str) -> str:
+    return urlparse(url).hostname or ''
+
+def timed(phase: str, url: str='', host: str=''):
+    if not METRICS:
+        return NULL_TIMER
+    return METRICS.timer(phase, host or get_host(url))
+
+def observe_metric(phase: str, seconds: float, host: str='') -> None:
+    if METRICS:
+        METRICS.observe(phase, seconds, host)
+
+def count_metric(name: str, amount: float=1, **labels) -> None:
+    if METRICS:
+        METRICS.count(name, amount, **labels)
+
+def count_response(url: str, response) -> None:
+    if METRICS:
+        METRICS.count('responses_total', host=get_host(url), status=str(response.status_code))
+
+def configure_session(pool_connections=32, pool_maxsize=16, timeout=30.0, retries=3, backoff=0.5) -> requests.Session:
+    global SESSION
+    retry = CountingRetry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS.union(['POST']),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = TimeoutHTTPAdapter(timeout, pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = 'gzip, deflate, br' if brotli else 'gzip, deflate'
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    with SESSION_LOCK:
+        if SESSION:
+            SESSION.close()
+        SESSION = session
+    return session
+
+def configure_scheduler(enabled=True, robots=True, max_concurrency=8, min_delay=0.0) -> Optional[HostScheduler]:
+    global SCHEDULER
+    SCHEDULER = HostScheduler(robots, max_concurrency, min_delay) if enabled else None
+    return SCHEDULER
 
-def get_locator(target, exts) -> BaseLocator:
+def is_allowed(url: str) -> bool:
+    return not SCHEDULER or SCHEDULER.is_allowed(url)
+
+def get_expected_digest(headers) -> Optional[bytes]:
+    """SHA-256 of a whole document from its Repr-Digest or Digest header, if the server sent one."""
+    for header, prefix in [('Repr-Digest', 'sha-256=:'), ('Digest', 'sha-256=')]:
+        for value in headers.get(header, '').split(','):
+            value = value.strip()
+            if value.lower().startswith(prefix):
+                try:
+                    return base64.b64decode(value[len(prefix):].strip(':'))
+                except ValueError:
+                    return None
+    return None
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def get_session() -> requests.Session:
+    with SESSION_LOCK:
+        if not SESSION:
+            configure_session()
+        return SESSION
+
+def configure_page_cache(cache_dir, cache_max_size=0, cache_max_age=0.0) -> Optional[PageCache]:
+    global PAGE_CACHE
+    PAGE_CACHE = None
+    if cache_dir:
+        PAGE_CACHE = PageCache(cache_dir, cache_max_size * 1024 * 1024, cache_max_age * 24 * 60 * 60)
+        logging.info(f'Using page cache at {cache_dir} with {len(PAGE_CACHE.sizes)} cached pages')
+    return PAGE_CACHE
+
+def get_locator(target, exts, workers=1, checkpoint=None, resume=False, on_location=None, parser='html.parser', near_duplicate_distance=0,
+                visit_limit=None, compact_visited=False, sitemaps=False, max_page_size=MAX_PAGE_SIZE, parse_workers=0, stop=None) -> BaseLocator:
     if op.isfile(target):
         target_ext = op.splitext(target)[1]
         if target_ext == '.json':
             return JsonLocator(target, exts)
+        if target_ext == '.jsonl':
+            return JsonLocator(target, exts, lazy=True)
+        if is_location_db(target):
+            return SqliteLocator(target, exts)
         return TxtLocator(target, exts)
     path = urlparse(target).path
     if path.lower().strip('/') == 'documentcenter':
-        return DocumentCenterLocator(target, exts)
-    return WebLocator(target, exts)
+        return DocumentCenterLocator(target, exts, workers, checkpoint, resume, on_location, stop)
+    return WebLocator(target, exts, workers, checkpoint, resume, on_location, parser, near_duplicate_distance, visit_limit, compact_visited, sitemaps, max_page_size,
+                      parse_workers, stop)
 
 def format_outfile_name(outfile, target, exts):
     if op.isfile(target):
@@ -322,48 +2260,271 @@ def format_outfile_name(outfile, target, exts):
     exts = '_'.join(exts).replace('.', '')
     return outfile.format(exts=exts, target=sanitize_filename(target, replacement_text='_'))
 
-def locate(target, doctype, ext, locate_outfile, log_level) -> BaseLocator:
-    exts = get_extensions(doctype, ext)
-    locator = get_locator(target, exts)
+def configure_run(cache_dir='', cache_max_size=0, cache_max_age=0.0, http_pool_connections=32, http_pool_maxsize=16, http_timeout=30.0,
+                  http_retries=3, http_backoff=0.5, politeness_robots=True, politeness_max_concurrency=8, politeness_min_delay=0.0,
+                  metrics_json='', metrics_prometheus='') -> Optional[PageCache]:
+    """Sets up the metrics, HTTP session, host scheduler and page cache shared by every target of a run."""
+    configure_metrics(bool(metrics_json or metrics_prometheus))
+    configure_session(http_pool_connections, http_pool_maxsize, http_timeout, http_retries, http_backoff)
+    configure_scheduler(True, politeness_robots, politeness_max_concurrency, politeness_min_delay)
+    return configure_page_cache(cache_dir, cache_max_size, cache_max_age)
+
+def get_locate_outfile(target, exts, locate_outfile, locate_format='json') -> str:
     locate_outfile = format_outfile_name(locate_outfile, target, exts)
+    if locate_format == 'jsonl' and locate_outfile.endswith('.json'):
+        locate_outfile += 'l'
+    if locate_format == 'sqlite' and locate_outfile.endswith('.json'):
+        locate_outfile = locate_outfile[:-len('.json')] + '.sqlite'
+    return locate_outfile
+
+def open_location_store(target, exts, locate_outfile, locate_format='json') -> Optional[LocationStore]:
+    """Opens the location database read from or written for target, if any."""
+    if op.isfile(target):
+        return LocationStore(target) if is_location_db(target) else None
+    locate_outfile = get_locate_outfile(target, exts, locate_outfile, locate_format)
+    if locate_format != 'sqlite' or not locate_outfile or op.isdir(locate_outfile):
+        return None
+    return LocationStore(locate_outfile, reset=True)
+
+def locate_target(target, exts, locate_outfile, locate_format='json', locate_parser='html.parser', locate_near_duplicate_distance=0,
+                  locate_visit_limit=250, locate_compact_visited=False, locate_sitemaps=False, locate_max_page_size=10, locate_parse_workers=0, locate_workers=1, locate_checkpoint='', resume=False,
+                  on_location: Optional[Callable[[Location], None]]=None, location_store: Optional[LocationStore]=None,
+                  stop: Optional[threading.Event]=None) -> BaseLocator:
+    if locate_parser == 'lxml' and not lxml:
+        logging.warning('Could not import lxml, falling back to html.parser')
+        locate_parser = 'html.parser'
+    locate_checkpoint = format_outfile_name(locate_checkpoint, target, exts)
+    locate_outfile = get_locate_outfile(target, exts, locate_outfile, locate_format)
     is_target_file = op.isfile(target)
     is_outfile_dir = op.isdir(locate_outfile)
-    if locate_outfile and not is_target_file and not is_outfile_dir:
+    is_writable = locate_outfile and not is_target_file and not is_outfile_dir
+    if is_writable:
         logging.info(f'Writing location info to {locate_outfile}')
         outdir = Path(op.dirname(op.realpath(locate_outfile)))
         outdir.mkdir(parents=True, exist_ok=True)
+    locator_options = {
+        'workers': locate_workers,
+        'checkpoint': locate_checkpoint,
+        'resume': resume,
+        'parser': locate_parser,
+        'near_duplicate_distance': locate_near_duplicate_distance,
+        'visit_limit': locate_visit_limit,
+        'compact_visited': locate_compact_visited,
+        'sitemaps': locate_sitemaps,
+        'max_page_size': locate_max_page_size * 1024 * 1024,
+        'parse_workers': locate_parse_workers,
+        'stop': stop,
+    }
+    if is_writable and locate_format == 'jsonl':
+        with Path(locate_outfile).open('w', buffering=1) as fo:
+            def _write_location(location):
+                fo.write(json.dumps(asdict(location)) + '\n')
+                if on_location:
+                    on_location(location)
+            locator = get_locator(target, exts, on_location=_write_location, **locator_options)
+    elif is_writable and locate_format == 'sqlite':
+        store = location_store or LocationStore(locate_outfile, reset=True)
+        def _store_location(location):
+            store.add(location)
+            if on_location:
+                on_location(location)
+        try:
+            locator = get_locator(target, exts, on_location=_store_location, **locator_options)
+        finally:
+            if location_store:
+                store.commit()
+            else:
+                store.close()
+    else:
+        locator = get_locator(target, exts, on_location=on_location, **locator_options)
+    if is_writable and locate_format == 'json':
         outfile = Path(locate_outfile)
         locations = [asdict(location) for location in locator.locations]
         with outfile.open('w') as fo:
             json.dump(locations, fo, indent=4)
     return locator
 
-def download(target, doctype, ext, locate_outfile, log_level, download_outdir) -> None:
-    locator = locate(target, doctype, ext, locate_outfile, log_level)
+def locate(target, doctype, ext, locate_outfile, log_level, locate_format='json', locate_parser='html.parser', locate_near_duplicate_distance=0,
+           locate_visit_limit=250, locate_compact_visited=False, locate_sitemaps=False, locate_max_page_size=10, locate_parse_workers=0, locate_workers=1, locate_checkpoint='', resume=False, cache_dir='', cache_max_size=0, cache_max_age=0.0,
+           http_pool_connections=32, http_pool_maxsize=16, http_timeout=30.0, http_retries=3, http_backoff=0.5,
+           politeness_robots=True, politeness_max_concurrency=8, politeness_min_delay=0.0,
+           metrics_json='', metrics_prometheus='') -> BaseLocator:
+    exts = get_extensions(doctype, ext)
+    page_cache = configure_run(cache_dir, cache_max_size, cache_max_age, http_pool_connections, http_pool_maxsize, http_timeout, http_retries, http_backoff,
+                               politeness_robots, politeness_max_concurrency, politeness_min_delay, metrics_json, metrics_prometheus)
+    locator = locate_target(target, exts, locate_outfile, locate_format, locate_parser, locate_near_duplicate_distance, locate_visit_limit,
+                            locate_compact_visited, locate_sitemaps, locate_max_page_size, locate_parse_workers, locate_workers, locate_checkpoint, resume)
+    if page_cache:
+        logging.info(f'Page cache: {page_cache.summary()}')
+    write_metrics(metrics_json, metrics_prometheus)
+    return locator
+
+def get_download_engine(download_outdir, download_manifest='', download_store='', download_store_link='hardlink', download_workers=1,
+                        download_host_limit=0, download_range_parts=1, download_range_threshold=32, location_store=None) -> DownloadEngine:
     outdir = Path(op.realpath(download_outdir))
     outdir.mkdir(parents=True, exist_ok=True)
-    locations = get_unique_locations(locator.locations)
-    total_locations = len(locations)
-    logging.info(f'Starting download of {total_locations} unique docs')
-    for num, location in enumerate(locations, 1):
-        try:
-            outpath = location.outpath(download_outdir)
-            outpath.parent.mkdir(parents=True, exist_ok=True)
-            logging.info(f'Downloading doc {num} of {total_locations}: {outpath}')
-            content = requests.get(location.docurl).content
-            with outpath.open('wb') as fo:
-                fo.write(content)
-        except Exception:
-            logging.error(f'Could not download/write {location.docurl}')
+    manifest = None
+    if download_manifest:
+        manifest = DownloadManifest(download_manifest.format(outdir=download_outdir))
+    store = None
+    if download_store:
+        store = ContentStore(download_store.format(outdir=download_outdir), download_store_link)
+    return DownloadEngine(download_outdir, download_workers, download_host_limit, manifest, store, download_range_parts,
+                          download_range_threshold * 1024 * 1024, location_store=location_store)
 
-def get_unique_locations(locations: List[Location]) -> List[Location]:
-    unique = []
-    docurls = set()
-    for location in locations:
-        if location.docurl not in docurls:
-            unique.append(location)
-            docurls.add(location.docurl)
-    return unique
+def log_download(engine: DownloadEngine, stats: DownloadStats) -> None:
+    logging.info(f'Completed download: {stats.summary()}')
+    if engine.store:
+        logging.info(f'Content store: {engine.store.summary()}')
+
+def split_run_options(options: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Splits CLI options into those of `configure_run` and those of `locate_target`."""
+    run_options = {key: value for key, value in options.items() if key.startswith(('cache_', 'http_', 'politeness_'))}
+    return run_options, {key: value for key, value in options.items() if key not in run_options}
+
+def download(target, doctype, ext, locate_outfile, log_level, download_outdir, download_manifest='', download_store='', download_store_link='hardlink',
+             download_workers=1, download_host_limit=0, download_range_parts=1, download_range_threshold=32, metrics_json='', metrics_prometheus='',
+             **locate_options) -> DownloadStats:
+    """Locates docs from target and downloads them as they are located."""
+    exts = get_extensions(doctype, ext)
+    run_options, target_options = split_run_options(locate_options)
+    page_cache = configure_run(metrics_json=metrics_json, metrics_prometheus=metrics_prometheus, **run_options)
+    # Download status is recorded in the location database read or written, if any.
+    location_store = open_location_store(target, exts, locate_outfile, target_options.get('locate_format', 'json'))
+    engine = get_download_engine(download_outdir, download_manifest, download_store, download_store_link, download_workers, download_host_limit,
+                                 download_range_parts, download_range_threshold, location_store)
+    try:
+        with DownloadPipeline(engine) as pipeline:
+            locator = locate_target(target, exts, locate_outfile, on_location=pipeline.put, location_store=location_store, **target_options)
+            # Location files are read without callbacks, and this is a no-op for locations already queued.
+            for location in locator.iter_locations():
+                pipeline.put(location)
+    finally:
+        if location_store:
+            location_store.close()
+    if page_cache:
+        logging.info(f'Page cache: {page_cache.summary()}')
+    stats = pipeline.get_stats()
+    log_download(engine, stats)
+    write_metrics(metrics_json, metrics_prometheus)
+    return stats
+
+def read_targets(targets_file: str) -> List[str]:
+    targets = []
+    with open(targets_file) as fi:
+        for line in fi:
+            target = line.strip()
+            if target and not target.startswith('#') and target not in targets:
+                targets.append(target)
+    return targets
+
+def locate_batch_target(target, exts, locate_outfile, on_location=None, location_stores: Optional[BatchLocationStores]=None,
+                        **locate_options) -> Dict[str, Any]:
+    start = time.monotonic()
+    result = {'target': target, 'visited': 0, 'located': 0, 'elapsed': 0.0, 'error': None}
+    try:
+        location_store = location_stores.open(target, exts, locate_outfile, locate_options.get('locate_format', 'json')) if location_stores else None
+        if location_store and on_location:
+            put = on_location
+            def on_location(location):
+                location_stores.route(location, location_store)
+                put(location)
+        locator = locate_target(target, exts, locate_outfile, on_location=on_location, location_store=location_store, **locate_options)
+        located = 0
+        for location in locator.iter_locations():
+            located += 1
+            if on_location:
+                on_location(location)
+        result.update(visited=len(locator.visited), located=located)
+    except Exception as exc:
+        logging.error(f'Could not locate docs from target {target}: {exc}')
+        result['error'] = str(exc) or type(exc).__name__
+    result['elapsed'] = time.monotonic() - start
+    return result
+
+def batch(targets_file, doctype, ext, locate_outfile, log_level, batch_workers=4, batch_download=False, batch_summary='',
+          download_outdir='__output__', download_manifest='', download_store='', download_store_link='hardlink', download_workers=1,
+          download_host_limit=0, download_range_parts=1, download_range_threshold=32, metrics_json='', metrics_prometheus='', **locate_options) -> Dict[str, Any]:
+    """Locates, and optionally downloads, docs from every target in `targets_file` within one run.
+
+    Targets share the HTTP pools, host scheduler, page cache and metrics. Each writes its own location file,
+    the docs located from all targets are downloaded as they are found by one pool of download workers.
+    """
+    start = time.monotonic()
+    exts = get_extensions(doctype, ext)
+    run_options, target_options = split_run_options(locate_options)
+    page_cache = configure_run(metrics_json=metrics_json, metrics_prometheus=metrics_prometheus, **run_options)
+    targets = read_targets(targets_file)
+    logging.info(f'Starting batch of {len(targets)} targets with {batch_workers} workers')
+    engine = None
+    location_stores = None
+    pipeline = nullcontext()
+    if batch_download:
+        # Download status is recorded in the location databases of the targets, if any.
+        location_stores = BatchLocationStores()
+        engine = get_download_engine(download_outdir, download_manifest, download_store, download_store_link, download_workers, download_host_limit,
+                                     download_range_parts, download_range_threshold, location_stores)
+        pipeline = DownloadPipeline(engine)
+    stop = threading.Event()
+    try:
+        with pipeline, ThreadPoolExecutor(max_workers=batch_workers) as executor:
+            on_location = pipeline.put if engine else None
+            futures = [executor.submit(locate_batch_target, target, exts, locate_outfile, on_location, location_stores, stop=stop, **target_options)
+                       for target in targets]
+            try:
+                results = [future.result() for future in futures]
+            except KeyboardInterrupt:
+                # Queued targets are dropped, running ones stop and save their checkpoints.
+                logging.warning('Stopping batch, waiting for running targets to save their checkpoints')
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        if location_stores:
+            location_stores.close()
+    summary = {
+        'targets': results,
+        'failed': sum(1 for result in results if result['error']),
+        'visited': sum(result['visited'] for result in results),
+        'located': sum(result['located'] for result in results),
+        'download': None,
+    }
+    if engine:
+        stats = pipeline.get_stats()
+        log_download(engine, stats)
+        summary['download'] = asdict(stats)
+    if page_cache:
+        logging.info(f'Page cache: {page_cache.summary()}')
+    summary['elapsed'] = time.monotonic() - start
+    logging.info(f'Completed batch of {len(results)} targets ({summary["failed"]} failed) in {summary["elapsed"]:.2f}s, '
+                 f'visited {summary["visited"]} pages, located {summary["located"]} docs')
+    if batch_summary:
+        logging.info(f'Writing batch summary to {batch_summary}')
+        Path(batch_summary).parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(Path(batch_summary), [json.dumps(summary, indent=4).encode()])
+    write_metrics(metrics_json, metrics_prometheus)
+    return summary
+
+def write_atomic(outpath: Path, chunks: Iterable[bytes], digest=None) -> int:
+    fd, temppath = tempfile.mkstemp(prefix=f'.{outpath.name}.', suffix='.tmp', dir=outpath.parent)
+    size = 0
+    writing = 0.0
+    try:
+        with os.fdopen(fd, 'wb') as fo:
+            for chunk in chunks:
+                start = time.perf_counter()
+                fo.write(chunk)
+                writing += time.perf_counter() - start
+                size += len(chunk)
+                if digest:
+                    digest.update(chunk)
+        os.replace(temppath, outpath)
+        observe_metric('write', writing)
+    except BaseException:
+        os.unlink(temppath)
+        raise
+    return size
 
 def get_baseurl(url) -> ParseResult:
     parsed = urlparse(url)
@@ -400,10 +2561,15 @@ def cli_group(**kwargs) -> None:
 @cli_group.command(name='locate', help='Locate documents from target.')
 @add_options('exts')
 @add_options('locate')
+@add_options('target')
+@add_options('cache')
+@add_options('http')
+@add_options('politeness')
+@add_options('metrics')
 @add_options('log')
-def cli_locate(target, doctype, ext, locate_outfile, log_level) -> None:
+def cli_locate(**kwargs) -> None:
     try:
-        locate(target, doctype, ext, locate_outfile, log_level)
+        locate(**kwargs)
     except KeyboardInterrupt:
         logging.error(f'Exiting due to user request.')
         sys.exit(1)
@@ -411,15 +2577,37 @@ def cli_locate(target, doctype, ext, locate_outfile, log_level) -> None:
 @cli_group.command(name='download', help='Locate and download documents from target.')
 @add_options('exts')
 @add_options('locate')
+@add_options('target')
+@add_options('cache')
+@add_options('http')
+@add_options('politeness')
+@add_options('metrics')
 @add_options('download')
 @add_options('log')
-def cli_download(target, doctype, ext, locate_outfile, log_level, download_outdir) -> None:
+def cli_download(**kwargs) -> None:
     try:
-        download(target, doctype, ext, locate_outfile, log_level, download_outdir)
+        download(**kwargs)
     except KeyboardInterrupt:
         logging.error(f'Exiting due to user request.')
         sys.exit(1)
 
+@cli_group.command(name='batch', help='Locate, and optionally download, documents from every target listed in a file.')
+@add_options('exts')
+@add_options('locate')
+@add_options('cache')
+@add_options('http')
+@add_options('politeness')
+@add_options('metrics')
+@add_options('download')
+@add_options('batch')
+@add_options('log')
+def cli_batch(**kwargs) -> None:
+    try:
+        batch(**kwargs)
+    except KeyboardInterrupt:
+        logging.error('Exiting due to user request.')
+        sys.exit(1)
+
 @cli_group.command(name='extensions', help='List extensions parsed from options.')
 @add_options('exts')
 def cli_extensions(doctype, ext) -> None:
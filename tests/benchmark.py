@@ -0,0 +1,258 @@
+"""Offline benchmark of the locators and downloader against synthetic local websites.
+
+Run from the repository root, e.g.:
+
+    python3 tests/benchmark.py --pages 2000 --report __output__/benchmark.json
+
+The report is JSON so runs of different versions can be compared with `--baseline`.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict
+from urllib.parse import parse_qs, urlparse
+import json
+import logging
+import os.path as op
+import platform
+import random
+import subprocess
+import sys; sys.path.append(op.realpath(op.join(op.dirname(op.realpath(__file__)), '../src')))
+import tempfile
+import threading
+import time
+
+import click
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+##==============================================================#
+## SECTION: Synthetic Site                                      #
+##==============================================================#
+
+def generate_site(rootdir: Path, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Writes a site under `rootdir/site` and returns a summary of what it holds."""
+    rand = random.Random(params['seed'])
+    sitedir = rootdir / 'site'
+    for subdir in ['p', 'dup', 'docs', 'large']:
+        (sitedir / subdir).mkdir(parents=True, exist_ok=True)
+    pages = params['pages']
+    docs = []
+    for num in range(pages):
+        links = [f'/site/p/{child}.html' for child in (num + 1, num * 2 + 1, num * 2 + 2, rand.randrange(pages)) if child < pages]
+        if num < params['duplicates']:
+            links.append(f'/site/dup/{num}.html')
+            links.append(f'{params["baseurl"]}/site/p/{num}.html?sid={rand.randrange(10 ** 6)}')
+        for docnum in range(params['docs_per_page']):
+            docurl = f'/site/docs/{num}-{docnum}.pdf'
+            (sitedir / docurl[len('/site/'):]).write_bytes(rand.getrandbits(8 * params['doc_kb'] * 1024).to_bytes(params['doc_kb'] * 1024, 'little'))
+            docs.append(docurl)
+            links.append(docurl)
+        links.append(f'/site/docs/{rand.randrange(num + 1)}-0.pdf')
+        content = '<html><body><p>Page {}</p>{}</body></html>'.format(num, ''.join(f'<a href="{link}">{link}</a>' for link in links))
+        (sitedir / 'p' / f'{num}.html').write_text(content)
+        if num < params['duplicates']:
+            (sitedir / 'dup' / f'{num}.html').write_text(content)
+    large = []
+    for num in range(params['large_docs']):
+        path = sitedir / 'large' / f'{num}.pdf'
+        with path.open('wb') as fo:
+            for _ in range(params['large_doc_mb']):
+                fo.write(rand.getrandbits(8 * 1024 * 1024).to_bytes(1024 * 1024, 'little'))
+        large.append(f'/site/large/{num}.pdf')
+    index = ''.join(f'<a href="{link}">{link}</a>' for link in ['p/0.html', 'trap/'] + large)
+    (sitedir / 'index.html').write_text(f'<html><body>{index}</body></html>')
+    return {'pages': pages, 'docs': docs, 'large_docs': large}
+
+class SyntheticSiteHandler(SimpleHTTPRequestHandler):
+    """Serves the generated files plus a crawl-loop trap under /site/trap/ and a DocumentCenter stand-in."""
+    FOLDER_FANOUT = 3
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.startswith('/site/trap'):
+            return self.send_content('<html><body><a href="trap/">deeper</a></body></html>', 'text/html')
+        if path.lower().rstrip('/') == '/documentcenter':
+            folders = ''.join(f'<div class="t-mid"><span class="t-in">Root {num}</span><input class="t-input" value="{num}"></div>'
+                              for num in range(SyntheticSiteHandler.FOLDER_FANOUT))
+            return self.send_content(f'<html><body>{folders}</body></html>', 'text/html')
+        super().do_GET()
+
+    def do_POST(self):
+        body = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        if self.path == '/documentcenter/Home/Document_AjaxBinding':
+            value = body['id'][0]
+            docs = [{'FileType': 'pdf', 'URL': f'/site/docs/{num}-0.pdf', 'DisplayName': f'{value}-{num}'}
+                    for num in range(sum(map(ord, value)) % 5, self.server.params['pages'], max(1, self.server.params['pages'] // 5))]
+            return self.send_content(json.dumps({'data': docs}), 'application/json')
+        if self.path == '/documentcenter/Home/_AjaxLoading':
+            value = body['Value'][0]
+            subdirs = []
+            if value.count('-') < self.server.params['folder_depth']:
+                subdirs = [{'Text': f'Folder {value}-{num}', 'Value': f'{value}-{num}'} for num in range(SyntheticSiteHandler.FOLDER_FANOUT)]
+            return self.send_content(json.dumps(subdirs), 'application/json')
+        self.send_error(404)
+
+    def send_content(self, content: str, content_type: str) -> None:
+        encoded = content.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+def start_server(rootdir: Path, params: Dict[str, Any]) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', params['port']), partial(SyntheticSiteHandler, directory=str(rootdir)))
+    server.daemon_threads = True
+    server.params = params
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+##==============================================================#
+## SECTION: Scenarios                                           #
+##==============================================================#
+
+def get_peak_rss_mb() -> float:
+    if not resource:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 2)
+
+def run_web_locate(params: Dict[str, Any]) -> Dict[str, Any]:
+    from documentsdownloader import WebLocator
+    start = time.monotonic()
+    locator = WebLocator(f'{params["baseurl"]}/site/', ['.pdf'], workers=params['locate_workers'], visit_limit=params['pages'] * 4,
+                         parse_workers=params['parse_workers'])
+    elapsed = time.monotonic() - start
+    return {
+        'elapsed': elapsed,
+        'pages': len(locator.visited),
+        'pages_per_sec': len(locator.visited) / elapsed,
+        'docs': len(locator.locations),
+        'docs_per_sec': len(locator.locations) / elapsed,
+        'duplicates': locator.duplicates,
+    }
+
+def run_documentcenter_locate(params: Dict[str, Any]) -> Dict[str, Any]:
+    from documentsdownloader import DocumentCenterLocator
+    start = time.monotonic()
+    locator = DocumentCenterLocator(f'{params["baseurl"]}/documentcenter', ['.pdf'], workers=params['locate_workers'])
+    elapsed = time.monotonic() - start
+    return {
+        'elapsed': elapsed,
+        'pages': len(locator.visited),
+        'pages_per_sec': len(locator.visited) / elapsed,
+        'docs': len(locator.locations),
+        'docs_per_sec': len(locator.locations) / elapsed,
+    }
+
+def run_download(params: Dict[str, Any]) -> Dict[str, Any]:
+    from documentsdownloader import download
+    outdir = op.join(params['workdir'], 'downloads')
+    start = time.monotonic()
+    stats = download(params['locations'], ['pdf'], [], '', 'warning', outdir, download_manifest='',
+                     download_workers=params['download_workers'], download_host_limit=0)
+    elapsed = time.monotonic() - start
+    megabytes = stats.bytes / (1024 * 1024)
+    return {
+        'elapsed': elapsed,
+        'docs': stats.fetched,
+        'failed': stats.failed,
+        'docs_per_sec': stats.fetched / elapsed,
+        'megabytes': megabytes,
+        'mb_per_sec': megabytes / elapsed,
+    }
+
+SCENARIOS = {
+    'web_locate': run_web_locate,
+    'documentcenter_locate': run_documentcenter_locate,
+    'download': run_download,
+}
+
+def run_scenario(name: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    result = SCENARIOS[name](params)
+    result['peak_rss_mb'] = get_peak_rss_mb()
+    return {key: round(value, 3) if isinstance(value, float) else value for key, value in result.items()}
+
+##==============================================================#
+## SECTION: Report                                              #
+##==============================================================#
+
+def get_version() -> str:
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=op.dirname(op.realpath(__file__)), text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    """Ratios of the current to the baseline value of every shared numeric metric."""
+    ratios = {}
+    for name, result in report['results'].items():
+        previous = baseline.get('results', {}).get(name, {})
+        for key, value in result.items():
+            if isinstance(value, (int, float)) and previous.get(key):
+                ratios.setdefault(name, {})[key] = round(value / previous[key], 3)
+    return ratios
+
+@click.command(help='Benchmark locating and downloading against synthetic local websites.')
+@click.option('--pages', default=500, show_default=True, help='Number of HTML pages in the synthetic site.')
+@click.option('--docs-per-page', default=2, show_default=True, help='Unique documents linked from each page.')
+@click.option('--doc-kb', default=16, show_default=True, help='Size of each small document in KB.')
+@click.option('--large-docs', default=2, show_default=True, help='Number of large documents.')
+@click.option('--large-doc-mb', default=32, show_default=True, help='Size of each large document in MB.')
+@click.option('--duplicates', default=50, show_default=True, help='Number of pages with a mirrored copy and a session-ID variant.')
+@click.option('--folder-depth', default=4, show_default=True, help='Depth of the DocumentCenter folder tree, each folder has 3 subfolders.')
+@click.option('--locate-workers', default=4, show_default=True, help='Workers used by the locators.')
+@click.option('--parse-workers', default=0, show_default=True, help='Worker processes parsing crawled pages, 0 to parse in the crawling process.')
+@click.option('--download-workers', default=4, show_default=True, help='Workers used by the downloader.')
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(sorted(SCENARIOS)), help='Scenarios to run, defaults to all.')
+@click.option('--seed', default=0, show_default=True, help='Random seed of the synthetic site.')
+@click.option('--port', default=0, help='Port of the local server, 0 picks a free one.')
+@click.option('--report', default='', help='Write the JSON report to given file path.')
+@click.option('--baseline', default='', help='JSON report of a previous run to compare against.')
+def cli_benchmark(report, baseline, scenarios, **params) -> None:
+    with tempfile.TemporaryDirectory() as workdir:
+        rootdir = Path(workdir, 'root')
+        server = start_server(rootdir, params)
+        params['baseurl'] = f'http://127.0.0.1:{server.server_port}'
+        params['workdir'] = workdir
+        generated = generate_site(rootdir, params)
+        params['locations'] = op.join(workdir, 'locations.jsonl')
+        with open(params['locations'], 'w') as fo:
+            for docurl in generated['docs'] + generated['large_docs']:
+                docurl = params['baseurl'] + docurl
+                fo.write(json.dumps({'target': params['baseurl'], 'source': params['baseurl'], 'docurl': docurl, 'docext': '.pdf'}) + '\n')
+        results = {}
+        for name in scenarios or sorted(SCENARIOS):
+            # A fresh process per scenario keeps peak RSS measurements separate.
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results[name] = executor.submit(run_scenario, name, params).result()
+        server.shutdown()
+    output = {
+        'version': get_version(),
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'params': {key: value for key, value in params.items() if key not in ['baseurl', 'workdir', 'locations']},
+        'results': results,
+    }
+    if baseline:
+        with open(baseline) as fi:
+            output['baseline'] = compare(output, json.load(fi))
+    content = json.dumps(output, indent=4)
+    if report:
+        Path(report).parent.mkdir(parents=True, exist_ok=True)
+        Path(report).write_text(content)
+    print(content)
+
+if __name__ == '__main__':
+    cli_benchmark()
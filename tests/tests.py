@@ -1,8 +1,156 @@
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+import errno
+import gzip
+import json
+import os
 import os.path as op
+import signal
 import sys; sys.path.append(op.realpath(op.join(op.dirname(op.realpath(__file__)), '../src')))
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
-from documentsdownloader import DocumentCenterLocator, Location, WebLocator, is_crawl_loop
+from bs4 import BeautifulSoup
+from imageDownloader.imagedownloader import ImageDownloader
+from pdfDownloader.pdfdownloader import PdfDownloader
+
+from documentsdownloader import batch, download, ContentStore, DocumentCenterLocator, DownloadEngine, DownloadManifest, DownloadPipeline, HostScheduler, JsonLocator, Location, LocationStore, PageCache, WebLocator, configure_metrics, configure_page_cache, configure_scheduler, configure_session, extract_links, canonicalize_url, find_files, find_page_docs, fingerprint, get_page, get_session, get_soup, is_crawl_loop, locate, lxml, simhash, to_absolute_url, write_atomic, SimhashIndex
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class FlakyHandler(QuietHandler):
+    """Responds with 503 while the server has failures left."""
+
+    def do_GET(self):
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        super().do_GET()
+
+class DocumentCenterHandler(QuietHandler):
+    """Mimics a CivicEngage DocumentCenter with folder `f` holding subfolders `f-0`, `f-1` down to `DEPTH` levels."""
+    DEPTH = 3
+
+    def do_GET(self):
+        folders = ''.join(f'<div class="t-mid"><span class="t-in">Root {num}</span><input class="t-input" value="{num}"></div>' for num in range(2))
+        self.send_json(f'<html><body>{folders}</body></html>', 'text/html')
+
+    def do_POST(self):
+        body = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        if self.path == '/documentcenter/Home/Document_AjaxBinding':
+            value = body['id'][0]
+            docs = [{'FileType': ext, 'URL': f'/DocumentCenter/View/{value}-{ext}', 'DisplayName': f'{value}.{ext}'} for ext in ['pdf', 'docx']]
+            self.send_json({'data': docs})
+        elif self.path == '/documentcenter/Home/_AjaxLoading':
+            value = body['Value'][0]
+            subdirs = []
+            if value.count('-') < self.DEPTH:
+                subdirs = [{'Text': f'Folder {value}-{num}', 'Value': f'{value}-{num}'} for num in range(2)]
+            self.send_json(subdirs)
+        else:
+            self.send_error(404)
+
+    def send_json(self, data, content_type='application/json'):
+        content = (data if isinstance(data, str) else json.dumps(data)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+class SlowPageHandler(QuietHandler):
+    """Logs requested paths, pages named `slow*` are served after a delay."""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if 'slow' in self.path:
+            time.sleep(0.5)
+        super().do_GET()
+        self.server.requests.append(f'served {self.path}')
+
+class MethodLogHandler(QuietHandler):
+    """Logs the method and path of every request."""
+
+    def do_HEAD(self):
+        self.server.requests.append(f'HEAD {self.path}')
+        super().do_HEAD()
+
+    def do_GET(self):
+        self.server.requests.append(f'GET {self.path}')
+        super().do_GET()
+
+class RangeHandler(QuietHandler):
+    """Serves byte ranges of files, ranges starting at an offset in `server.failing_ranges` fail once.
+
+    Like servers that ignore Range, the whole file is sent when `server.ignore_ranges` is set or If-Range is not the strong `server.etag`.
+    """
+
+    def do_GET(self):
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            return self.send_error(404)
+        content = path.read_bytes()
+        header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        self.server.if_ranges.append(if_range)
+        if not header or self.server.ignore_ranges or (if_range and (if_range.startswith('W/') or if_range != self.server.etag)):
+            return self.send_content(200, content)
+        start, end = [int(num) for num in header[len('bytes='):].split('-')]
+        self.server.ranges.append(start)
+        if start in self.server.failing_ranges:
+            self.server.failing_ranges.remove(start)
+            return self.send_error(500)
+        self.send_content(206, content[start:end + 1], f'bytes {start}-{end}/{len(content)}')
+
+    def send_content(self, status, content, content_range=None):
+        self.send_response(status)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', self.server.etag)
+        if content_range:
+            self.send_header('Content-Range', content_range)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+class LocalSiteTestCase(unittest.TestCase):
+    """Serves a temporary directory over HTTP, populate it with `add_file`."""
+    HANDLER = FlakyHandler
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.sitedir = Path(self.tempdir.name, 'site')
+        self.outdir = Path(self.tempdir.name, 'out')
+        self.sitedir.mkdir()
+        handler = partial(self.HANDLER, directory=str(self.sitedir))
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.failures = 0
+        self.baseurl = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        configure_scheduler(enabled=False)
+        self.server.shutdown()
+        self.server.server_close()
+        self.tempdir.cleanup()
+
+    def add_file(self, relpath, content) -> str:
+        path = self.sitedir / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if isinstance(content, str):
+            content = content.encode()
+        path.write_bytes(content)
+        return f'{self.baseurl}/{relpath}'
 
 class TestIsCrawlLoop(unittest.TestCase):
 
@@ -18,6 +166,13 @@ class TestIsCrawlLoop(unittest.TestCase):
     def test_can_ignore_four_noncontiguous_repeated_path_segs(self):
         self.assertFalse(is_crawl_loop('Visiting https://www.google.com/intl/en/ads/home/home/other/home/home/how-it-works', 4))
 
+class TestCanonicalizeUrl(unittest.TestCase):
+
+    def test_can_normalize_url_variants(self):
+        self.assertEqual('http://example.com/a/c?a=1&b=2', canonicalize_url('HTTP://Example.COM:80/a/b/../c/?b=2&a=1#top'))
+        self.assertEqual('https://example.com/', canonicalize_url('https://example.com:443'))
+        self.assertEqual('https://example.com:8443/a', canonicalize_url('https://example.com:8443/a//'))
+
 class TestLocation(unittest.TestCase):
 
     def test_can_handle_upper_ext_in_docurl(self):
@@ -39,6 +194,25 @@ class TestDocumentCenterLocator(unittest.TestCase):
         self.assertGreater(len(locator.locations), 100)
         self.assertGreater(len(locator.visited), 10)
 
+class TestLocalDocumentCenterLocator(LocalSiteTestCase):
+    HANDLER = DocumentCenterHandler
+
+    def test_can_crawl_folders_concurrently(self):
+        serial = DocumentCenterLocator(f'{self.baseurl}/documentcenter', ['.pdf'], workers=1)
+        concurrent = DocumentCenterLocator(f'{self.baseurl}/documentcenter', ['.pdf'], workers=4)
+        self.assertEqual(30, len(serial.visited))
+        self.assertEqual(serial.visited, concurrent.visited)
+        self.assertEqual(30, len(serial.locations))
+        self.assertEqual(sorted(map(str, serial.locations)), sorted(map(str, concurrent.locations)))
+        location = next(location for location in serial.locations if location.docurl.endswith('/0-1-0-pdf'))
+        self.assertEqual(op.join('Root 0', 'Folder 0-1', 'Folder 0-1-0'), location.extra['dir'])
+
+    def test_should_skip_failed_listings(self):
+        configure_session(retries=0)
+        self.addCleanup(configure_session)
+        locator = DocumentCenterLocator(f'{self.baseurl}/documentcenter/missing', ['.pdf'])
+        self.assertEqual(0, len(locator.locations))
+
 class TestWebLocator(unittest.TestCase):
 
     def test_can_crawl(self):
@@ -86,5 +260,735 @@ class TestWebLocator(unittest.TestCase):
         self.assertFalse(WebLocator('test', []).is_visitable('https://www.arlis.org/docs/sysadm/SW_DVD5_Office_Professional_Plus_2016_W32_English_MLF_X20-41353.ISO'))
         self.assertFalse(WebLocator('test', []).is_visitable('https://www.arlis.org/docs/sysadm/SW_DVD5_Office_Professional_Plus_2016_W32_English_MLF_X20-41353.ISO'))
 
+class TestDownloadEngine(LocalSiteTestCase):
+
+    def make_locations(self, count):
+        locations = []
+        for num in range(count):
+            docurl = self.add_file(f'docs/doc{num}.pdf', f'content {num}')
+            locations.append(Location(self.baseurl, self.baseurl, docurl, '.pdf'))
+        return locations
+
+    def test_can_download_concurrently(self):
+        locations = self.make_locations(10)
+        stats = DownloadEngine(str(self.outdir), workers=4, host_limit=2).run(locations)
+        self.assertEqual(10, stats.fetched)
+        self.assertEqual(0, stats.failed)
+        for num, location in enumerate(locations):
+            self.assertEqual(f'content {num}', location.outpath(str(self.outdir)).read_text())
+
+    def test_can_count_failed_downloads(self):
+        locations = self.make_locations(2)
+        locations.append(Location(self.baseurl, self.baseurl, 'http://127.0.0.1:1/missing.pdf', '.pdf'))
+        configure_session(retries=0)
+        self.addCleanup(configure_session)
+        stats = DownloadEngine(str(self.outdir), workers=2).run(locations)
+        self.assertEqual(2, stats.fetched)
+        self.assertEqual(1, stats.failed)
+
+    def test_can_skip_unchanged_docs_using_manifest(self):
+        locations = self.make_locations(3)
+        manifest_path = self.outdir / 'manifest.json'
+        DownloadEngine(str(self.outdir), manifest=DownloadManifest(manifest_path)).run(locations)
+        stats = DownloadEngine(str(self.outdir), manifest=DownloadManifest(manifest_path)).run(locations)
+        self.assertEqual(0, stats.fetched)
+        self.assertEqual(3, stats.skipped)
+
+    def test_should_refetch_doc_when_local_copy_changed(self):
+        locations = self.make_locations(1)
+        manifest_path = self.outdir / 'manifest.json'
+        DownloadEngine(str(self.outdir), manifest=DownloadManifest(manifest_path)).run(locations)
+        outpath = locations[0].outpath(str(self.outdir))
+        outpath.write_text('trunc')
+        stats = DownloadEngine(str(self.outdir), manifest=DownloadManifest(manifest_path)).run(locations)
+        self.assertEqual(1, stats.fetched)
+        self.assertEqual('content 0', outpath.read_text())
+
+    def test_can_store_identical_docs_once(self):
+        locations = self.make_locations(2)
+        for num in range(2):
+            docurl = self.add_file(f'mirror/doc{num}.pdf', 'content 0')
+            locations.append(Location(self.baseurl, self.baseurl, docurl, '.pdf'))
+        store = ContentStore(self.outdir / 'store')
+        stats = DownloadEngine(str(self.outdir), workers=2, store=store).run(locations)
+        self.assertEqual((4, 2), (stats.fetched, stats.deduplicated))
+        outpaths = [location.outpath(str(self.outdir)) for location in locations]
+        self.assertTrue(op.samefile(outpaths[0], outpaths[2]))
+        self.assertTrue(op.samefile(outpaths[0], outpaths[3]))
+        self.assertFalse(op.samefile(outpaths[0], outpaths[1]))
+        index = json.loads((self.outdir / 'store' / 'index.json').read_text())
+        self.assertEqual([1, 3], sorted(len(entry['locations']) for entry in index.values()))
+
+    def test_can_link_stored_docs_with_symlinks(self):
+        locations = self.make_locations(1)
+        DownloadEngine(str(self.outdir), store=ContentStore(self.outdir / 'store', link='symlink')).run(locations)
+        outpath = locations[0].outpath(str(self.outdir))
+        self.assertTrue(outpath.is_symlink())
+        self.assertEqual('content 0', outpath.read_text())
+
+    def test_can_store_docs_on_another_filesystem(self):
+        locations = self.make_locations(1)
+        replace = os.replace
+        def _replace(src, dst):
+            if Path(dst).parent.parent == self.outdir / 'store' and Path(src).parent.parent != self.outdir / 'store':
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            return replace(src, dst)
+        with mock.patch('os.replace', _replace):
+            DownloadEngine(str(self.outdir), store=ContentStore(self.outdir / 'store')).run(locations)
+        outpath = locations[0].outpath(str(self.outdir))
+        self.assertEqual('content 0', outpath.read_text())
+        self.assertEqual(1, len([path for path in (self.outdir / 'store').glob('*/*')]))
+
+    def test_should_remove_unreferenced_blobs(self):
+        locations = self.make_locations(1)
+        DownloadEngine(str(self.outdir), store=ContentStore(self.outdir / 'store')).run(locations)
+        self.add_file('docs/doc0.pdf', 'changed')
+        store = ContentStore(self.outdir / 'store')
+        DownloadEngine(str(self.outdir), store=store).run(locations)
+        self.assertEqual('changed', locations[0].outpath(str(self.outdir)).read_text())
+        self.assertEqual(1, len(store.index))
+        self.assertEqual(1, len([path for path in (self.outdir / 'store').glob('*/*')]))
+
+class TestLocalWebLocator(LocalSiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for num in range(6):
+            links = ''.join(f'<a href="page{child}.html">page {child}</a>' for child in (num * 2 + 1, num * 2 + 2))
+            self.add_file(f'page{num}.html' if num else 'index.html', f'<html><body>{links}<a href="/docs/doc{num}.pdf">doc</a></body></html>')
+            self.add_file(f'docs/doc{num}.pdf', 'pdf')
+
+    def test_can_crawl_with_one_worker(self):
+        locator = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1)
+        self.assertEqual([f'{self.baseurl}/docs/doc{num}.pdf' for num in range(6)], [location.docurl for location in locator.locations])
+        self.assertEqual(13, len(locator.visited))
+
+    def test_can_crawl_with_many_workers(self):
+        serial = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1)
+        concurrent = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=4)
+        self.assertEqual(sorted(serial.visited), sorted(concurrent.visited))
+        self.assertEqual(sorted(location.docurl for location in serial.locations), sorted(location.docurl for location in concurrent.locations))
+
+    def test_can_parse_pages_in_worker_processes(self):
+        self.add_file('mirror.html', self.sitedir.joinpath('page1.html').read_text())
+        self.add_file('index.html', self.sitedir.joinpath('index.html').read_text() + '<a href="mirror.html">mirror</a><a href="http://other.invalid/x.html">x</a>')
+        serial = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1)
+        pooled = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=2, parse_workers=2, near_duplicate_distance=3)
+        self.assertEqual(sorted(serial.visited), sorted(pooled.visited))
+        self.assertEqual(sorted(location.docurl for location in serial.locations), sorted(location.docurl for location in pooled.locations))
+        self.assertEqual((1, 1), (serial.duplicates, pooled.duplicates))
+
+    def test_can_skip_duplicate_pages(self):
+        index = self.sitedir.joinpath('index.html').read_text()
+        self.add_file('index.html', index + '<a href="mirror.html">mirror</a><a href="session.html">session</a>')
+        self.add_file('mirror.html', self.sitedir.joinpath('page1.html').read_text())
+        self.add_file('session.html', self.sitedir.joinpath('page2.html').read_text().replace('.html"', '.html?sid=1"'))
+        exact = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1)
+        self.assertEqual(1, exact.duplicates)
+        near = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1, near_duplicate_distance=3)
+        self.assertEqual(2, near.duplicates)
+        self.assertEqual(set(location.docurl for location in exact.locations), set(location.docurl for location in near.locations))
+        self.assertLess(len(near.locations), len(exact.locations))
+
+    def test_can_resume_interrupted_crawl(self):
+        class InterruptedWebLocator(WebLocator):
+            def visit(self, url, soup):
+                if len(self.locations) == 3:
+                    raise KeyboardInterrupt()
+                super().visit(url, soup)
+        checkpoint = str(self.outdir / 'checkpoint.json')
+        with self.assertRaises(KeyboardInterrupt):
+            InterruptedWebLocator(f'{self.baseurl}/', ['.pdf'], workers=1, checkpoint=checkpoint)
+        self.assertTrue(op.isfile(checkpoint))
+        resumed = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1, checkpoint=checkpoint, resume=True)
+        self.assertEqual([f'{self.baseurl}/docs/doc{num}.pdf' for num in range(6)], [location.docurl for location in resumed.locations])
+        self.assertEqual(13, len(resumed.visited))
+        self.assertFalse(op.isfile(checkpoint))
+
+    def test_can_collapse_url_variants(self):
+        index = self.sitedir.joinpath('index.html').read_text()
+        self.add_file('index.html', index + f'<a href="page1.html#top">top</a><a href="{self.baseurl.upper()}/page2.html">upper</a><a href="./page1.html/">slash</a>')
+        locator = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1)
+        self.assertEqual(13, len(locator.visited))
+
+    def test_can_limit_visited_pages(self):
+        locator = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1, visit_limit=3)
+        self.assertEqual(3, len(locator.visited))
+        self.assertEqual([f'{self.baseurl}/docs/doc{num}.pdf' for num in range(3)], [location.docurl for location in locator.locations])
+
+    def test_can_crawl_with_compact_visited_set(self):
+        exact = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1)
+        compact = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1, compact_visited=True)
+        self.assertEqual(len(exact.visited), len(compact.visited))
+        self.assertTrue(all(url in compact.visited for url in exact.visited))
+        self.assertEqual(exact.locations, compact.locations)
+
+    def test_can_resume_compact_crawl(self):
+        class InterruptedWebLocator(WebLocator):
+            def visit(self, url, soup):
+                if len(self.locations) == 3:
+                    raise KeyboardInterrupt()
+                super().visit(url, soup)
+        checkpoint = str(self.outdir / 'checkpoint.json')
+        with self.assertRaises(KeyboardInterrupt):
+            InterruptedWebLocator(f'{self.baseurl}/', ['.pdf'], workers=1, checkpoint=checkpoint, compact_visited=True)
+        resumed = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1, checkpoint=checkpoint, resume=True)
+        self.assertTrue(resumed.compact_visited)
+        self.assertEqual([f'{self.baseurl}/docs/doc{num}.pdf' for num in range(6)], [location.docurl for location in resumed.locations])
+        self.assertEqual(13, len(resumed.visited))
+
+    def test_can_seed_crawl_from_sitemaps(self):
+        urlset = lambda urls: '<?xml version="1.0"?><urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{}</urlset>'.format(
+            ''.join(f'<url><loc>{url}</loc></url>' for url in urls))
+        self.add_file('robots.txt', f'User-agent: *\nSitemap: {self.baseurl}/sitemap-index.xml\n')
+        self.add_file('sitemap-index.xml', '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{}</sitemapindex>'.format(
+            ''.join(f'<sitemap><loc>{self.baseurl}/{name}</loc></sitemap>' for name in ['pages.xml', 'docs.xml.gz'])))
+        self.add_file('pages.xml', urlset([f'{self.baseurl}/orphan.html', f'{self.baseurl}/page1.html', 'http://other.invalid/outside.html']))
+        self.add_file('docs.xml.gz', gzip.compress(urlset([f'{self.baseurl}/docs/{name}' for name in ['listed.pdf', 'doc1.pdf', 'listed.xls']] + ['http://other.invalid/outside.pdf']).encode()))
+        self.add_file('orphan.html', '<a href="/docs/orphan.pdf">doc</a>')
+        locator = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1, sitemaps=True)
+        docurls = [location.docurl for location in locator.locations]
+        self.assertEqual([f'{self.baseurl}/docs/listed.pdf', f'{self.baseurl}/docs/doc1.pdf'], docurls[:2])
+        self.assertIn(f'{self.baseurl}/docs/orphan.pdf', docurls)
+        self.assertIn(f'{self.baseurl}/orphan.html', locator.visited)
+        self.assertEqual(14, len(locator.visited))
+        self.assertNotIn('http://other.invalid/outside.pdf', docurls)
+        scoped = WebLocator(f'{self.baseurl}/page1.html', ['.pdf'], workers=1, sitemaps=True)
+        self.assertEqual([f'{self.baseurl}/docs/doc1.pdf'], [location.docurl for location in scoped.locations])
+
+    def test_can_crawl_without_sitemaps(self):
+        locator = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1, sitemaps=True)
+        self.assertEqual([f'{self.baseurl}/docs/doc{num}.pdf' for num in range(6)], [location.docurl for location in locator.locations])
+
+    def test_can_write_and_read_jsonl_locations(self):
+        outfile = str(self.outdir / 'locations-{exts}.json')
+        locator = locate(f'{self.baseurl}/', ['pdf'], [], outfile, 'info', locate_format='jsonl', locate_workers=2)
+        jsonl = str(self.outdir / 'locations-pdf.jsonl')
+        self.assertEqual(6, len(Path(jsonl).read_text().splitlines()))
+        self.assertEqual(locator.locations, list(JsonLocator(jsonl, ['.pdf'], lazy=True).iter_locations()))
+        self.assertEqual([], list(JsonLocator(jsonl, ['.xls'], lazy=True).iter_locations()))
+        self.assertEqual(locator.locations, locate(jsonl, ['pdf'], [], outfile, 'info').locations)
+        self.assertEqual({}, find_files(jsonl, str(self.outdir)))
+
+class TestContentSniffing(LocalSiteTestCase):
+    HANDLER = MethodLogHandler
+
+    def setUp(self):
+        super().setUp()
+        self.server.requests = []
+
+    def test_can_sniff_pages_without_head_requests(self):
+        self.add_file('index.html', '<a href="about">about</a><a href="view.cfm">view</a><a href="report.cfm">report</a><a href="big.cfm">big</a>')
+        self.add_file('about', '<!DOCTYPE html><html><body><a href="/docs/a.pdf">a</a></body></html>')
+        self.add_file('view.cfm', '<html><body><a href="docs/b.pdf">b</a></body></html>')
+        self.add_file('report.cfm', '%PDF-1.4 <a href="docs/c.pdf">c</a>')
+        self.add_file('big.cfm', '<html><body><a href="docs/d.pdf">d</a>' + ' ' * 2048 + '</body></html>')
+        locator = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1, max_page_size=1024)
+        self.assertEqual([f'{self.baseurl}/docs/a.pdf', f'{self.baseurl}/docs/b.pdf'], [location.docurl for location in locator.locations])
+        self.assertIn(f'{self.baseurl}/report.cfm', locator.skipped_urls)
+        self.assertFalse([request for request in self.server.requests if request.startswith('HEAD')])
+
+    def test_should_tell_failed_pages_from_non_html(self):
+        self.add_file('index.html', '<a href="missing.cfm">missing</a><a href="report.cfm">report</a>')
+        self.add_file('report.cfm', '%PDF-1.4')
+        locator = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1)
+        self.assertFalse(locator.is_visitable(f'{self.baseurl}/missing.cfm'))
+        self.assertIn(f'{self.baseurl}/missing.cfm', locator.visited)
+        self.assertNotIn(f'{self.baseurl}/missing.cfm', locator.skipped_urls)
+        self.assertIn(f'{self.baseurl}/report.cfm', locator.skipped_urls)
+        self.assertEqual({(f'127.0.0.1:{self.server.server_port}', '/', '.cfm'): [0, 1]}, locator.content_types)
+
+    def test_can_reuse_content_type_of_similar_urls(self):
+        self.add_file('index.html', ''.join(f'<a href="files/{num}.dat">{num}</a><a href="app/{num}.cfm">{num}</a>' for num in range(5)))
+        for num in range(5):
+            self.add_file(f'files/{num}.dat', b'\x00\x01binary')
+            self.add_file(f'app/{num}.cfm', f'<html><body><a href="/docs/{num}.pdf">doc</a></body></html>')
+        locator = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=1)
+        self.assertEqual(5, len(locator.locations))
+        self.assertEqual(['GET /files/0.dat', 'GET /files/1.dat', 'GET /files/2.dat'], [request for request in self.server.requests if '.dat' in request])
+        self.assertIn(f'{self.baseurl}/files/4.dat', locator.skipped_urls)
+
+class TestRangedDownload(LocalSiteTestCase):
+    HANDLER = RangeHandler
+
+    def setUp(self):
+        super().setUp()
+        self.server.ranges = []
+        self.server.failing_ranges = set()
+        self.server.if_ranges = []
+        self.server.ignore_ranges = False
+        self.server.etag = '"v1"'
+        configure_session(retries=0)
+        self.addCleanup(configure_session)
+        patcher = mock.patch.object(DownloadEngine, 'RANGE_SIZE', 1000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.content = bytes(range(256)) * 20
+        self.location = Location(self.baseurl, self.baseurl, self.add_file('docs/large.pdf', self.content), '.pdf')
+
+    def test_can_download_in_parallel_ranges(self):
+        stats = DownloadEngine(str(self.outdir), range_parts=3, range_threshold=1000).run([self.location])
+        self.assertEqual((1, 0), (stats.fetched, stats.failed))
+        self.assertEqual(self.content, self.location.outpath(str(self.outdir)).read_bytes())
+        self.assertEqual([0, 1000, 2000, 3000, 4000, 5000], sorted(self.server.ranges))
+
+    def test_should_count_ranges_against_host_limit(self):
+        locations = [self.location, Location(self.baseurl, self.baseurl, self.add_file('docs/other.pdf', self.content), '.pdf')]
+        engine = DownloadEngine(str(self.outdir), workers=2, host_limit=3, range_parts=4, range_threshold=1000)
+        fetch_ranges = engine.fetch_ranges
+        streams = []
+        def _fetch_ranges(*args):
+            streams.append(engine.active[urlparse(self.baseurl).netloc])
+            return fetch_ranges(*args)
+        with mock.patch.object(engine, 'fetch_ranges', _fetch_ranges):
+            stats = engine.run(locations)
+        self.assertEqual((2, 0), (stats.fetched, stats.failed))
+        self.assertEqual(2, len(streams))
+        self.assertLessEqual(max(streams), 3)
+        self.assertEqual(0, engine.active[urlparse(self.baseurl).netloc])
+
+    def test_should_not_split_small_docs(self):
+        DownloadEngine(str(self.outdir), range_parts=3, range_threshold=10000).run([self.location])
+        self.assertEqual(self.content, self.location.outpath(str(self.outdir)).read_bytes())
+        self.assertEqual([], self.server.ranges)
+
+    def test_can_resume_interrupted_download(self):
+        self.server.failing_ranges = {3000}
+        stats = DownloadEngine(str(self.outdir), range_parts=2, range_threshold=1000).run([self.location])
+        outpath = self.location.outpath(str(self.outdir))
+        self.assertEqual(1, stats.failed)
+        self.assertFalse(outpath.exists())
+        self.assertTrue(outpath.with_name('large.pdf.part').is_file())
+        self.server.ranges = []
+        stats = DownloadEngine(str(self.outdir), range_parts=2, range_threshold=1000).run([self.location])
+        self.assertEqual(1, stats.fetched)
+        self.assertEqual([3000], self.server.ranges)
+        self.assertEqual(self.content, outpath.read_bytes())
+        self.assertEqual([outpath.name], [path.name for path in outpath.parent.iterdir()])
+
+    def test_should_not_send_weak_etag_in_if_range(self):
+        self.server.etag = 'W/"v1"'
+        stats = DownloadEngine(str(self.outdir), range_parts=3, range_threshold=1000).run([self.location])
+        self.assertEqual((1, 0), (stats.fetched, stats.failed))
+        self.assertEqual(6, len(self.server.ranges))
+        self.assertEqual([None] * 7, self.server.if_ranges)
+
+    def test_can_fall_back_when_ranges_are_ignored(self):
+        self.server.ignore_ranges = True
+        stats = DownloadEngine(str(self.outdir), range_parts=3, range_threshold=1000).run([self.location])
+        outpath = self.location.outpath(str(self.outdir))
+        self.assertEqual((1, 0), (stats.fetched, stats.failed))
+        self.assertEqual(self.content, outpath.read_bytes())
+        self.assertEqual([outpath.name], [path.name for path in outpath.parent.iterdir()])
+
+class TestDownloadPipeline(LocalSiteTestCase):
+    HANDLER = SlowPageHandler
+
+    def setUp(self):
+        super().setUp()
+        self.server.requests = []
+
+    def test_can_download_while_locating(self):
+        self.add_file('index.html', '<a href="/docs/doc0.pdf">doc</a><a href="slow.html">slow</a>')
+        self.add_file('slow.html', '<a href="/docs/doc0.pdf">doc</a><a href="/docs/doc1.pdf">doc</a>')
+        self.add_file('docs/doc0.pdf', 'content 0')
+        self.add_file('docs/doc1.pdf', 'content 1')
+        outfile = str(self.outdir / 'locations.json')
+        stats = download(f'{self.baseurl}/', ['pdf'], [], outfile, 'info', str(self.outdir / 'docs'), locate_workers=1, download_workers=1)
+        self.assertLess(self.server.requests.index('/docs/doc0.pdf'), self.server.requests.index('served /slow.html'))
+        self.assertEqual((2, 0), (stats.fetched, stats.failed))
+        self.assertEqual(3, len(json.loads(Path(outfile).read_text())))
+
+    def test_can_interrupt_with_full_queue(self):
+        engine = DownloadEngine(str(self.outdir))
+        locations = [Location(self.baseurl, self.baseurl, f'{self.baseurl}/docs/{num}.pdf', '.pdf') for num in range(8)]
+        with mock.patch.object(DownloadPipeline, 'QUEUE_SIZE', 2), mock.patch.object(engine, 'fetch', side_effect=lambda *args: time.sleep(0.2)):
+            with self.assertRaises(KeyboardInterrupt):
+                with DownloadPipeline(engine) as pipeline:
+                    for location in locations:
+                        pipeline.put(location)
+                    self.assertTrue(pipeline.queue.full())
+                    raise KeyboardInterrupt()
+        self.assertFalse(pipeline.thread.is_alive())
+
+class TestDownloaderFacades(LocalSiteTestCase):
+    HANDLER = SlowPageHandler
+
+    def test_can_download_each_doctype_from_one_page_fetch(self):
+        self.server.requests = []
+        url = self.add_file('page.html', '<a href="/docs/a.pdf">a</a><a href="/img/b.PNG">b</a><a href="docs/c.docx">c</a>')
+        for relpath in ['docs/a.pdf', 'img/b.PNG', 'docs/c.docx']:
+            self.add_file(relpath, relpath)
+        self.outdir.mkdir()
+        cwd = os.getcwd()
+        os.chdir(self.outdir)
+        self.addCleanup(os.chdir, cwd)
+        self.assertEqual(1, PdfDownloader(url).download_pdfs().fetched)
+        self.assertEqual(1, ImageDownloader(url).download_images().fetched)
+        folder = Path(str(self.outdir) + 'webscraping')
+        self.assertEqual(['a.pdf', 'b.PNG'], sorted(path.name for path in folder.iterdir()))
+        self.assertEqual(1, self.server.requests.count('/page.html'))
+
+    def test_should_refetch_page_after_ttl(self):
+        self.server.requests = []
+        url = self.add_file('ttl.html', '<a href="/docs/a.pdf">a</a>')
+        self.add_file('docs/a.pdf', 'a')
+        find_page_docs(url)
+        find_page_docs(url)
+        self.assertEqual(1, self.server.requests.count('/ttl.html'))
+        with mock.patch('documentsdownloader.PAGE_DOCS_TTL', 0):
+            find_page_docs(url)
+        self.assertEqual(2, self.server.requests.count('/ttl.html'))
+
+class TestLocationStore(LocalSiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.add_file('index.html', '<a href="page.html">page</a><a href="/docs/a.pdf">a</a><a href="/docs/b.xls">b</a>')
+        self.add_file('page.html', '<a href="/docs/a.pdf">a</a><a href="/docs/c.pdf">c</a>')
+        self.add_file('docs/a.pdf', 'same')
+        self.add_file('docs/b.xls', 'b')
+        self.add_file('docs/c.pdf', 'same')
+
+    def test_can_dedup_and_filter_locations(self):
+        with LocationStore(self.outdir / 'locations.sqlite') as store:
+            for docurl, docext in [('a.pdf', '.pdf'), ('b.xls', '.xls'), ('a.pdf', '.pdf'), ('c.pdf', '.pdf')]:
+                store.add(Location('target', 'source', docurl, docext, {'name': docurl}))
+            self.assertEqual(4, store.count())
+            self.assertEqual(['.pdf', '.xls'], store.exts())
+            self.assertEqual(['a.pdf', 'c.pdf'], [location.docurl for location in store.iter_locations(['.pdf'], unique=True)])
+            self.assertEqual({'name': 'b.xls'}, next(store.iter_locations(['.xls'])).extra)
+            self.assertEqual([], list(store.iter_locations([])))
+
+    def test_can_locate_into_database(self):
+        outfile = str(self.outdir / 'locations-{exts}.json')
+        locator = locate(f'{self.baseurl}/', ['pdf'], ['xls'], outfile, 'info', locate_format='sqlite', locate_workers=1)
+        database = str(self.outdir / 'locations-pdf_xls.sqlite')
+        self.assertEqual(4, LocationStore(database).count())
+        self.assertEqual(sorted(set(location.docurl for location in locator.locations)),
+                         sorted(location.docurl for location in locate(database, ['pdf'], ['xls'], outfile, 'info').locations))
+        self.assertEqual([f'{self.baseurl}/docs/b.xls'], [location.docurl for location in locate(database, [], ['xls'], outfile, 'info').locations])
+
+    def test_can_cache_download_status(self):
+        outfile = str(self.outdir / 'locations.json')
+        docsdir = str(self.outdir / 'docs')
+        stats = download(f'{self.baseurl}/', ['pdf'], [], outfile, 'info', docsdir, locate_format='sqlite', locate_workers=1)
+        self.assertEqual(2, stats.fetched)
+        database = str(self.outdir / 'locations.sqlite')
+        with mock.patch.object(Path, 'is_file', side_effect=AssertionError('stat of a known file')):
+            files = find_files(database, docsdir)
+        self.assertEqual([2, 1], [len(locations) for locations in files.values()])
+        self.assertEqual(set(path for path in Path(docsdir).rglob('*') if path.is_file()), set(files))
+        with LocationStore(database) as store:
+            self.assertEqual([[f'{self.baseurl}/docs/a.pdf', f'{self.baseurl}/docs/c.pdf']], list(store.find_duplicates().values()))
+        next(iter(files)).unlink()
+        self.assertEqual(2, len(find_files(database, docsdir)))
+        self.assertEqual(1, len(find_files(database, docsdir, refresh=True)))
+
+    def test_should_stat_known_files_once_on_rerun(self):
+        outfile = str(self.outdir / 'locations.json')
+        docsdir = str(self.outdir / 'docs')
+        manifest = str(self.outdir / 'manifest.json')
+        download(f'{self.baseurl}/', ['pdf'], [], outfile, 'info', docsdir, download_manifest=manifest, locate_format='sqlite', locate_workers=1)
+        stat = Path.stat
+        statted = []
+        def _stat(path, **kwargs):
+            statted.append(str(path))
+            return stat(path, **kwargs)
+        with mock.patch.object(Path, 'stat', _stat):
+            stats = download(str(self.outdir / 'locations.sqlite'), ['pdf'], [], outfile, 'info', docsdir, download_manifest=manifest)
+        self.assertEqual((0, 2), (stats.fetched, stats.skipped))
+        # Only the existence check after a 304 touches the known files.
+        statted = [path for path in statted if path.startswith(docsdir + os.sep)]
+        self.assertEqual(2, len(statted))
+        self.assertEqual(len(statted), len(set(statted)))
+
+    def test_should_refetch_deleted_files_on_rerun(self):
+        outfile = str(self.outdir / 'locations.json')
+        docsdir = str(self.outdir / 'docs')
+        manifest = str(self.outdir / 'manifest.json')
+        download(f'{self.baseurl}/', ['pdf'], [], outfile, 'info', docsdir, download_manifest=manifest, locate_format='sqlite', locate_workers=1)
+        deleted = next(path for path in Path(docsdir).rglob('*.pdf'))
+        deleted.unlink()
+        stats = download(str(self.outdir / 'locations.sqlite'), ['pdf'], [], outfile, 'info', docsdir, download_manifest=manifest)
+        self.assertEqual((1, 1), (stats.fetched, stats.skipped))
+        self.assertTrue(deleted.is_file())
+
+class TestBatch(LocalSiteTestCase):
+    HANDLER = SlowPageHandler
+
+    def setUp(self):
+        super().setUp()
+        self.server.requests = []
+
+    def test_can_interrupt_batch(self):
+        for site in range(4):
+            self.add_file(f'{site}/index.html', '<a href="slow.html">slow</a>')
+            self.add_file(f'{site}/slow.html', '<a href="a.html">a</a><a href="b.html">b</a>')
+        self.add_file('targets.txt', ''.join(f'{self.baseurl}/{site}/\n' for site in range(4)))
+        checkpoint = str(self.outdir / 'checkpoint-{target}.json')
+        timer = threading.Timer(0.2, os.kill, [os.getpid(), signal.SIGINT])
+        timer.start()
+        self.addCleanup(timer.cancel)
+        with self.assertRaises(KeyboardInterrupt):
+            batch(str(self.sitedir / 'targets.txt'), ['pdf'], [], str(self.outdir / 'locations-{exts}-{target}.json'), 'info',
+                  batch_workers=1, locate_workers=1, locate_checkpoint=checkpoint)
+        self.assertFalse([request for request in self.server.requests if request.startswith(('/1', '/2', '/3'))])
+        state = json.loads(next(self.outdir.glob('checkpoint-*.json')).read_text())
+        self.assertEqual([f'{self.baseurl}/0/a.html', f'{self.baseurl}/0/b.html'], state['frontier'])
+
+    def test_can_locate_and_download_many_targets(self):
+        for site in ['a', 'b']:
+            self.add_file(f'{site}/index.html', f'<a href="page.html">page</a><a href="/docs/{site}.pdf">doc</a>')
+            self.add_file(f'{site}/page.html', '<a href="/docs/shared.pdf">doc</a>')
+            self.add_file(f'docs/{site}.pdf', site)
+        self.add_file('docs/shared.pdf', 'shared')
+        self.add_file('targets.txt', f'# sites\n{self.baseurl}/a/\n\n{self.baseurl}/b/\n{self.baseurl}/a/\n')
+        summary_path = self.outdir / 'summary.json'
+        summary = batch(str(self.sitedir / 'targets.txt'), ['pdf'], [], str(self.outdir / 'locations-{exts}-{target}.json'), 'info',
+                        batch_workers=2, batch_download=True, batch_summary=str(summary_path), download_outdir=str(self.outdir / 'docs'))
+        self.assertEqual([f'{self.baseurl}/a/', f'{self.baseurl}/b/'], [result['target'] for result in summary['targets']])
+        self.assertEqual((0, 4, 4), (summary['failed'], summary['visited'], summary['located']))
+        self.assertEqual(3, summary['download']['fetched'])
+        self.assertEqual(summary, json.loads(summary_path.read_text()))
+        self.assertEqual(2, len(list(self.outdir.glob('locations-pdf-*.json'))))
+
+    def test_can_record_download_status_of_many_targets(self):
+        for site in ['a', 'b']:
+            self.add_file(f'{site}/index.html', f'<a href="/docs/{site}.pdf">doc</a><a href="/docs/shared.pdf">doc</a>')
+            self.add_file(f'docs/{site}.pdf', site)
+        self.add_file('docs/shared.pdf', 'shared')
+        self.add_file('targets.txt', f'{self.baseurl}/a/\n{self.baseurl}/b/\n')
+        summary = batch(str(self.sitedir / 'targets.txt'), ['pdf'], [], str(self.outdir / 'locations-{exts}-{target}.json'), 'info',
+                        batch_workers=2, batch_download=True, download_outdir=str(self.outdir / 'docs'), locate_format='sqlite')
+        self.assertEqual(3, summary['download']['fetched'])
+        docurls = []
+        for database in self.outdir.glob('locations-pdf-*.sqlite'):
+            with LocationStore(database) as store:
+                docurls.extend(row[0] for row in store.db.execute("SELECT docurl FROM files WHERE status = 'downloaded'"))
+        self.assertEqual([f'{self.baseurl}/docs/{name}.pdf' for name in ['a', 'b', 'shared']], sorted(docurls))
+
+class TestSession(LocalSiteTestCase):
+
+    def tearDown(self):
+        configure_session()
+        super().tearDown()
+
+    def test_can_retry_unavailable_page(self):
+        url = self.add_file('index.html', 'ok')
+        configure_session(retries=2, backoff=0)
+        self.server.failures = 2
+        self.assertEqual(b'ok', get_page(url))
+
+    def test_should_give_up_after_retries(self):
+        url = self.add_file('index.html', 'ok')
+        configure_session(retries=1, backoff=0)
+        self.server.failures = 2
+        self.assertIsNone(get_page(url))
+        self.assertEqual(b'ok', get_page(url))
+
+class TestHostScheduler(LocalSiteTestCase):
+
+    class Response:
+        def __init__(self, status_code, headers={}):
+            self.status_code = status_code
+            self.headers = headers
+
+    def test_can_skip_disallowed_urls(self):
+        self.add_file('robots.txt', 'User-agent: *\nDisallow: /private/\n')
+        self.add_file('index.html', '<a href="private/page.html">private</a><a href="public.html">public</a>')
+        self.add_file('private/page.html', '<a href="/docs/private.pdf">doc</a>')
+        self.add_file('public.html', '<a href="/docs/public.pdf">doc</a><a href="/private/doc.pdf">doc</a>')
+        self.add_file('docs/public.pdf', 'public')
+        self.add_file('private/doc.pdf', 'private')
+        configure_scheduler(robots=True)
+        locator = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=2)
+        self.assertNotIn(f'{self.baseurl}/private/page.html', locator.visited)
+        self.assertEqual([f'{self.baseurl}/docs/public.pdf', f'{self.baseurl}/private/doc.pdf'], [location.docurl for location in locator.locations])
+        stats = DownloadEngine(str(self.outdir)).run(locator.locations)
+        self.assertEqual((1, 1), (stats.fetched, stats.disallowed))
+
+    def test_can_honor_crawl_delay(self):
+        self.add_file('robots.txt', 'User-agent: *\nCrawl-delay: 1\n')
+        self.add_file('index.html', '<a href="page1.html">1</a>')
+        self.add_file('page1.html', 'page')
+        configure_scheduler(robots=True)
+        start = time.monotonic()
+        locator = WebLocator(f'{self.baseurl}/', ['.pdf'], workers=2)
+        self.assertEqual(2, len(locator.visited))
+        self.assertGreaterEqual(time.monotonic() - start, 1.0)
+
+    def test_can_adapt_concurrency(self):
+        url = f'{self.baseurl}/page.html'
+        scheduler = configure_scheduler(robots=False, max_concurrency=4)
+        for _ in range(20):
+            scheduler.release(url, scheduler.acquire(url), self.Response(200))
+        self.assertEqual(4, scheduler.hosts['127.0.0.1'].limit)
+        scheduler.release(url, scheduler.acquire(url), self.Response(429, {'Retry-After': '0.3'}))
+        self.assertEqual(2, scheduler.hosts['127.0.0.1'].limit)
+        start = time.monotonic()
+        scheduler.release(url, scheduler.acquire(url), None)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(2, scheduler.hosts['127.0.0.1'].limit)
+
+    def test_can_hold_slot_until_body_is_read(self):
+        url = self.add_file('doc.pdf', 'x' * 1000)
+        scheduler = configure_scheduler(robots=False)
+        response = get_session().get(url, stream=True)
+        self.assertEqual(1, scheduler.hosts['127.0.0.1'].active)
+        self.assertEqual(1000, len(response.content))
+        self.assertEqual(0, scheduler.hosts['127.0.0.1'].active)
+        with get_session().get(url, stream=True):
+            self.assertEqual(1, scheduler.hosts['127.0.0.1'].active)
+        self.assertEqual(0, scheduler.hosts['127.0.0.1'].active)
+        get_session().get(url)
+        self.assertEqual(0, scheduler.hosts['127.0.0.1'].active)
+
+    def test_should_not_throttle_slowly_read_bodies(self):
+        url = self.add_file('doc.pdf', 'x' * 1000)
+        scheduler = configure_scheduler(robots=False)
+        get_session().get(url)
+        with get_session().get(url, stream=True) as response:
+            time.sleep(0.5)
+            self.assertEqual(1000, len(response.content))
+        self.assertGreater(scheduler.hosts['127.0.0.1'].limit, HostScheduler.INITIAL_LIMIT)
+
+class TestExtractLinks(unittest.TestCase):
+    PAGES = [
+        b'<html><body><a href="a.pdf">A</a><a href="/b.PDF">B</a><a href="page.html">page</a></body></html>',
+        b'<a href="x.pdf?download=1">x</a><A HREF="sub/">sub</A><a>no href</a><a href="">empty</a><a href="doc.pdfx">not a pdf</a>',
+        b'<html><head><script>var s = "<a href=in-script.pdf>";</script></head><body><p><a href="p.pdf"/><a href="http://other.com/o.pdf#frag">o</a>',
+        b'<a href="caf\xc3\xa9.pdf">utf8</a><a href="&quot;q&quot;.pdf">entity</a><a href=unquoted.pdf>unquoted</a>',
+        '<meta charset="latin-1"><a href="na\xefve.pdf">latin1</a>'.encode('latin-1'),
+        b'<?xml version="1.0" encoding="utf-8"?>\n<html xmlns="http://www.w3.org/1999/xhtml"><body><a href="x.pdf">xhtml</a></body></html>',
+    ]
+
+    @staticmethod
+    def soup_links(url, content, exts):
+        soup = BeautifulSoup(content, 'html.parser')
+        selector = ', '.join([f'a[href*="{ext}" i]' for ext in exts])
+        docurls = []
+        for tag in soup.select(selector):
+            docurl = to_absolute_url(urlparse(url), urlparse(tag['href']))
+            if op.splitext(urlparse(docurl).path)[1].lower() in exts:
+                docurls.append(docurl)
+        linkurls = [to_absolute_url(urlparse(url), urlparse(tag.get('href'))) for tag in soup.find_all('a') if tag.get('href')]
+        return docurls, linkurls
+
+    def test_can_match_soup_extraction(self):
+        for parser in ['html.parser', 'lxml'] if lxml else ['html.parser']:
+            for content in TestExtractLinks.PAGES:
+                expected = TestExtractLinks.soup_links('https://example.com/dir/', content, ['.pdf'])
+                self.assertEqual(expected, extract_links('https://example.com/dir/', content, ['.pdf'], parser), (parser, content))
+
+class TestFingerprints(unittest.TestCase):
+
+    def test_can_fingerprint_content(self):
+        self.assertEqual(fingerprint(b'<html></html>'), fingerprint(b'<html></html>'))
+        self.assertNotEqual(fingerprint(b'<html></html>'), fingerprint(b'<html> </html>'))
+
+    def test_can_find_near_duplicate_simhashes(self):
+        links = [f'/page{num}.html' for num in range(50)]
+        index = SimhashIndex(3)
+        self.assertTrue(index.add(simhash(links)))
+        self.assertFalse(index.add(simhash(links + ['/extra.html'])))
+        self.assertTrue(index.add(simhash([f'/other{num}.html' for num in range(50)])))
+
+class TestMetrics(LocalSiteTestCase):
+
+    def tearDown(self):
+        configure_metrics(False)
+        super().tearDown()
+
+    def test_can_report_phases_and_counters(self):
+        self.add_file('index.html', '<a href="page.html">page</a><a href="doc.pdf">doc</a>')
+        self.add_file('page.html', '<a href="doc.pdf">doc</a>')
+        docurl = self.add_file('doc.pdf', 'pdf')
+        metrics_json = str(self.outdir / 'metrics.json')
+        metrics_prometheus = str(self.outdir / 'metrics.prom')
+        configure_session()
+        locate(f'{self.baseurl}/', ['pdf'], [], '', 'info', metrics_json=metrics_json, metrics_prometheus=metrics_prometheus)
+        with open(metrics_json) as fi:
+            report = json.load(fi)
+        host = urlparse(docurl).hostname
+        phases = set((histogram['phase'], histogram['host']) for histogram in report['histograms'])
+        self.assertTrue({('connect', host), ('fetch', host), ('parse', host), ('find_locations', host)}.issubset(phases))
+        page_bytes = next(counter['value'] for counter in report['counters'] if counter['name'] == 'bytes_total' and counter['kind'] == 'page')
+        self.assertGreater(page_bytes, 0)
+        prometheus = Path(metrics_prometheus).read_text()
+        self.assertIn('# TYPE documentsdownloader_phase_seconds histogram', prometheus)
+        self.assertIn(f'documentsdownloader_responses_total{{host="{host}",status="200"}} 2', prometheus)
+
+    def test_should_not_collect_when_disabled(self):
+        self.assertIsNone(configure_metrics(False))
+        self.add_file('index.html', 'ok')
+        self.assertEqual(b'ok', get_page(f'{self.baseurl}/'))
+
+class TestPageCache(LocalSiteTestCase):
+
+    def tearDown(self):
+        configure_page_cache('')
+        super().tearDown()
+
+    def test_can_revalidate_cached_page(self):
+        url = self.add_file('index.html', '<a href="doc.pdf">doc</a>')
+        cache = configure_page_cache(str(self.outdir / 'cache'))
+        self.assertIsNotNone(get_soup(url).find('a'))
+        self.assertEqual(0, cache.hits)
+        self.assertIsNotNone(get_soup(url).find('a'))
+        self.assertEqual(1, cache.hits)
+
+    def test_can_evict_least_recently_used_pages(self):
+        cache = PageCache(self.outdir / 'cache', max_size=10)
+        headers = {'ETag': '"1"'}
+        cache.store('http://example.com/a', headers, b'aaaaaa')
+        time.sleep(0.01)
+        cache.store('http://example.com/b', headers, b'bbbbbb')
+        self.assertIsNone(cache.load('http://example.com/a'))
+        self.assertEqual(b'bbbbbb', cache.load('http://example.com/b'))
+
+    def test_can_evict_old_pages(self):
+        cache = PageCache(self.outdir / 'cache', max_age=0.01)
+        cache.store('http://example.com/a', {'ETag': '"1"'}, b'aaaaaa')
+        time.sleep(0.02)
+        self.assertEqual({}, cache.conditional_headers('http://example.com/a'))
+
+class TestWriteAtomic(unittest.TestCase):
+
+    def test_can_write_chunks(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            outpath = Path(tempdir, 'doc.pdf')
+            self.assertEqual(6, write_atomic(outpath, [b'abc', b'def']))
+            self.assertEqual(b'abcdef', outpath.read_bytes())
+
+    def test_should_keep_existing_file_on_failed_write(self):
+        def _chunks():
+            yield b'partial'
+            raise IOError('connection reset')
+        with tempfile.TemporaryDirectory() as tempdir:
+            outpath = Path(tempdir, 'doc.pdf')
+            outpath.write_bytes(b'original')
+            with self.assertRaises(IOError):
+                write_atomic(outpath, _chunks())
+            self.assertEqual(b'original', outpath.read_bytes())
+            self.assertEqual(['doc.pdf'], [path.name for path in Path(tempdir).iterdir()])
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_can_write_report(self):
+        from click.testing import CliRunner
+        from benchmark import cli_benchmark
+        with tempfile.TemporaryDirectory() as tempdir:
+            report = op.join(tempdir, 'report.json')
+            args = ['--pages', '10', '--duplicates', '2', '--large-docs', '1', '--large-doc-mb', '1', '--folder-depth', '1', '--report', report]
+            result = CliRunner().invoke(cli_benchmark, args)
+            self.assertEqual(0, result.exit_code, result.output)
+            with open(report) as fi:
+                results = json.load(fi)['results']
+        self.assertEqual(['documentcenter_locate', 'download', 'web_locate'], sorted(results))
+        self.assertEqual(21, results['download']['docs'])
+        self.assertGreater(results['web_locate']['pages'], 10)
+        self.assertEqual(12, results['documentcenter_locate']['pages'])
+
 if __name__ == '__main__':
     unittest.main()